@@ -0,0 +1,66 @@
+"""
+Sequential vs concurrent band loading of one item served from a local HTTP server.
+
+    python -m benchmarks.bench_concurrent_band_loading
+"""
+
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.http_server import LocalHTTPServer
+from benchmarks.synthetic_s2 import bbox_for_aoi, make_synthetic_item
+from src.sentinel2_handling.stac_item_sentinel2_processor import (
+    StacItemSentinel2Processor,
+)
+
+
+def load_bands(item, bbox, max_workers, run_id):
+    # a unique query string per run defeats GDAL's in-process HTTP cache
+    item = item.clone()
+    for asset in item.assets.values():
+        asset.href = f"{asset.href}?run={run_id}"
+    proc = StacItemSentinel2Processor(item=item, bbox=bbox, max_workers=max_workers)
+    start = time.perf_counter()
+    proc._load_and_clip_required_assets()
+    return time.perf_counter() - start, proc.s2_bands
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--aoi-px", type=int, default=600)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        make_synthetic_item(data_dir)
+        with LocalHTTPServer(data_dir, latency=args.latency) as server:
+            item = make_synthetic_item(data_dir, href_prefix=server.url)
+            bbox = bbox_for_aoi(args.aoi_px)
+
+            timings = {}
+            run_ids = iter(range(2 * args.repeats))
+            for label, max_workers in [("sequential", 1), ("concurrent", None)]:
+                runs = [
+                    load_bands(item, bbox, max_workers, next(run_ids))
+                    for _ in range(args.repeats)
+                ]
+                timings[label] = min(t for t, _ in runs)
+                bands = runs[0][1]
+                if label == "sequential":
+                    reference = bands
+                else:
+                    for name, raster in bands.items():
+                        if not np.array_equal(raster.img, reference[name].img):
+                            raise AssertionError(f"{name} differs from sequential read")
+
+    print(f"sequential: {timings['sequential']:.3f}s")
+    print(f"concurrent: {timings['concurrent']:.3f}s")
+    print(f"speedup:    {timings['sequential'] / timings['concurrent']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
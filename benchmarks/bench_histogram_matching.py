@@ -0,0 +1,78 @@
+"""
+match_images in a loop vs HistogramMatcher.match_batch over a synthetic time series.
+
+    python -m benchmarks.bench_histogram_matching
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from src.utils.img_utils import HistogramMatcher, match_images
+
+
+def make_frames(n_frames, size, dtype, seed=0):
+    rng = np.random.default_rng(seed)
+    frames = []
+    for t in range(n_frames):
+        gain = rng.uniform(0.6, 1.4, size=3)
+        img = rng.beta(2, 5, size=(size, size, 3)) * gain
+        img = np.clip(img, 0, 1)
+        if dtype == np.uint8:
+            img = (img * 255).astype(np.uint8)
+        elif dtype == np.uint16:
+            img = (img * 10000).astype(np.uint16)
+        else:
+            img = img.astype(dtype)
+        frames.append(img)
+    return frames
+
+
+def time_call(fn, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=48)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--repeats", type=int, default=2)
+    args = parser.parse_args()
+
+    cases = [
+        ("uint8", np.uint8, None),
+        ("uint16", np.uint16, None),
+        ("float64", np.float64, None),
+        ("float64, 4096 levels", np.float64, 4096),
+    ]
+    for label, dtype, float_levels in cases:
+        frames = make_frames(args.frames + 1, args.size, dtype)
+        ref, srcs = frames[0], frames[1:]
+
+        t_loop, expected = time_call(
+            lambda: [match_images(ref, src) for src in srcs], args.repeats
+        )
+        matcher = HistogramMatcher(ref, float_levels=float_levels)
+        t_batch, matched = time_call(lambda: matcher.match_batch(srcs), args.repeats)
+
+        diffs = np.stack(
+            [
+                np.abs(a.astype(np.float64) - b.astype(np.float64))
+                for a, b in zip(matched, expected)
+            ]
+        )
+        print(
+            f"{label:22s} loop {t_loop:.3f}s  batch {t_batch:.3f}s  "
+            f"speedup {t_loop / t_batch:5.2f}x  "
+            f"abs diff mean {diffs.mean():.1e} max {diffs.max():.1e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Import time of each module in a fresh interpreter, as paid by every joblib worker
+and short script, and which heavy optional dependencies the import pulls in.
+
+    python -m benchmarks.bench_import_time
+    python -m benchmarks.bench_import_time --json import_times.json
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+MODULES = [
+    "src.sentinel2_handling.base_classes.raster",
+    "src.sentinel2_handling.base_classes.spectral_indices",
+    "src.sentinel2_handling.stac_item_sentinel2_processor",
+    "src.sentinel2_handling.sentinel2_downloader",
+    "src.sentinel2_handling.datacube",
+    "src.sentinel2_handling.compositing",
+    "src.utils.img_utils",
+]
+
+# should only be imported when the code needing them runs
+HEAVY_DEPENDENCIES = [
+    "geopandas",
+    "cv2",
+    "skimage",
+    "joblib",
+    "pystac_client",
+    "planetary_computer",
+    "requests",
+]
+
+
+def import_time(module: str):
+    """
+    (seconds, heavy dependencies loaded) for importing module in a new interpreter.
+    Uses -X importtime, which reports the cumulative time of each import in us.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    total_us = 0
+    loaded = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        name = name.strip()
+        if name == module:
+            total_us = int(cumulative)
+        if name in HEAVY_DEPENDENCIES:
+            loaded.add(name)
+    return total_us / 1e6, sorted(loaded)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    for module in MODULES:
+        runs = [import_time(module) for _ in range(args.repeats)]
+        seconds = min(t for t, _ in runs)
+        results[module] = {"seconds": seconds, "heavy_imports": runs[0][1]}
+        heavy = ", ".join(runs[0][1]) or "-"
+        print(f"{module:55s} {seconds * 1000:7.1f} ms   heavy: {heavy}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Returning rasters from joblib process workers by pickling vs as shared memory
+descriptors (Raster.to_shared_memory / Raster.from_shared_memory).
+
+    python -m benchmarks.bench_shared_memory
+"""
+
+import argparse
+import time
+
+import numpy as np
+from joblib import Parallel, delayed
+from rasterio.transform import from_origin
+
+from src.sentinel2_handling.base_classes.raster import Raster
+
+
+def make_raster(seed, size, bands, shared):
+    rng = np.random.default_rng(seed)
+    raster = Raster(
+        img=rng.integers(0, 10000, (bands, size, size), dtype=np.uint16),
+        meta={"crs": "EPSG:32648", "transform": from_origin(0, 0, 10, 10)},
+        band_first=True,
+    )
+    return raster.to_shared_memory() if shared else raster
+
+
+def run(args, shared):
+    start = time.perf_counter()
+    results = Parallel(n_jobs=args.workers)(
+        delayed(make_raster)(seed, args.size, args.bands, shared)
+        for seed in range(args.rasters)
+    )
+    if shared:
+        results = [Raster.from_shared_memory(desc) for desc in results]
+    return time.perf_counter() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rasters", type=int, default=16)
+    parser.add_argument("--size", type=int, default=2048)
+    parser.add_argument("--bands", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    # warm up the worker pool so both runs reuse it
+    Parallel(n_jobs=args.workers)(delayed(int)(n) for n in range(args.workers))
+
+    t_pickle, pickled = run(args, shared=False)
+    t_shared, shared = run(args, shared=True)
+    for a, b in zip(pickled, shared):
+        if not np.array_equal(a.img, b.img):
+            raise AssertionError("shared memory raster differs from the pickled one")
+
+    total_mb = sum(r.img.nbytes for r in shared) / 2**20
+    print(f"{args.rasters} rasters, {total_mb:.0f} MB in total")
+    print(f"pickled:        {t_pickle:.3f}s")
+    print(f"shared memory:  {t_shared:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Cloud screening of a batch of items over HTTP: full-resolution SCL reads vs
+TieredScreening (eo:cloud_cover, then SCL overviews, then full reads only near the
+threshold). Reports bytes, requests and time, and checks both keep the same items.
+Items are full size tiles with only their SCL written, so that the reads go past the
+header the HTTP opener fetches first.
+
+    python -m benchmarks.bench_tiered_screening
+"""
+
+import argparse
+import tempfile
+import time
+from collections import Counter
+
+from benchmarks.http_server import LocalHTTPServer
+from benchmarks.synthetic_s2 import bbox_for_aoi, make_synthetic_item
+from src.sentinel2_handling.remote_io import HTTPRangeOpener
+from src.sentinel2_handling.sentinel2_downloader import screen_item
+from src.sentinel2_handling.stac_item_sentinel2_processor import (
+    StacItemSentinel2Processor,
+    TieredScreening,
+    set_remote_opener,
+)
+
+
+def screen_all(items, bbox, min_usable_pct, screening):
+    opener = HTTPRangeOpener()
+    set_remote_opener(opener)
+    try:
+        start = time.perf_counter()
+        results = [
+            screen_item(item, bbox, min_usable_pct, screening=screening)
+            for item in items
+        ]
+        elapsed = time.perf_counter() - start
+    finally:
+        set_remote_opener(None)
+    return results, elapsed, opener.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--tile-px", type=int, default=10980)
+    parser.add_argument("--aoi-px", type=int, default=4000)
+    parser.add_argument("--min-usable-pct", type=float, default=85)
+    parser.add_argument("--tolerance", type=float, default=5.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        for seed in range(args.items):
+            make_synthetic_item(
+                data_dir,
+                item_id=f"S2_SYNTHETIC_{seed}",
+                size_10m=args.tile_px,
+                seed=seed,
+                bands=["SCL"],
+            )
+        with LocalHTTPServer(data_dir, latency=args.latency) as server:
+            items = [
+                make_synthetic_item(
+                    data_dir,
+                    item_id=f"S2_SYNTHETIC_{seed}",
+                    size_10m=args.tile_px,
+                    seed=seed,
+                    href_prefix=server.url,
+                    bands=["SCL"],
+                )
+                for seed in range(args.items)
+            ]
+            bbox = bbox_for_aoi(args.aoi_px, size_10m=args.tile_px)
+
+            full, t_full, full_stats = screen_all(
+                items, bbox, args.min_usable_pct, None
+            )
+            screening = TieredScreening(tolerance=args.tolerance)
+            tiered, t_tiered, tiered_stats = screen_all(
+                items, bbox, args.min_usable_pct, screening
+            )
+
+            estimates = []
+            for item in items:
+                proc = StacItemSentinel2Processor(item=item, bbox=bbox)
+                estimates.append(
+                    (
+                        proc.estimate_usable_pixels(screening.overview_factor),
+                        proc.compute_usable_pixels(),
+                    )
+                )
+
+    disagreements = sum(a.is_usable != b.is_usable for a, b in zip(full, tiered))
+    worst = max(abs(est - exact) for est, exact in estimates)
+    print(f"full:    {t_full:.3f}s  {full_stats}")
+    print(f"tiered:  {t_tiered:.3f}s  {tiered_stats}")
+    print(f"decided by tier: {dict(Counter(res.tier for res in tiered))}")
+    print(f"usable items: {sum(res.is_usable for res in full)} of {len(items)}")
+    print(f"worst overview estimate error: {worst:.2f} percentage points")
+    print(f"decisions differing from full screening: {disagreements}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Checks StacSearchCache against a stub client, without network access: a cold search
+fetches the whole window, repeating it makes no API call, and extending the window
+only asks for the new dates.
+
+    python -m benchmarks.check_stac_cache
+"""
+
+import tempfile
+from datetime import datetime, timedelta
+
+from src.sentinel2_handling.stac_cache import StacSearchCache, _item_datetime
+
+BBOX = [103.88, 1.39, 103.92, 1.42]
+
+
+def make_item(date: datetime):
+    return {
+        "type": "Feature",
+        "stac_version": "1.0.0",
+        "id": f"S2_STUB_{date:%Y%m%d}",
+        "geometry": None,
+        "properties": {"datetime": date.isoformat() + "Z", "eo:cloud_cover": 10},
+        "links": [],
+        "assets": {},
+    }
+
+
+class _StubSearch:
+    def __init__(self, items):
+        self._items = items
+
+    def items_as_dicts(self):
+        return iter(self._items)
+
+
+class StubClient:
+    """An item every 5 days; records the datetime ranges it was searched with."""
+
+    def __init__(self, start: datetime, days: int):
+        self.items = [make_item(start + timedelta(days=d)) for d in range(0, days, 5)]
+        self.searches = []
+
+    def search(self, collections, bbox, datetime, query):
+        start, end = (_parse(d) for d in datetime.split("/"))
+        self.searches.append((start, end))
+        return _StubSearch(
+            [item for item in self.items if start <= _item_datetime(item) <= end]
+        )
+
+
+def _parse(date: str) -> datetime:
+    return datetime.fromisoformat(date)
+
+
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+
+def main():
+    start = datetime(2024, 1, 1)
+    client = StubClient(start, days=120)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = StacSearchCache(cache_dir, client=client)
+
+        # cold: one search over the whole window
+        end = start + timedelta(days=60)
+        cold = cache.search(BBOX, start, end)
+        check(cache.api_searches == 1, f"cold search made {cache.api_searches} calls")
+        check(client.searches == [(start, end)], f"cold ranges {client.searches}")
+        check(len(cold) == 13, f"cold search returned {len(cold)} items")
+
+        # warm: same window, served from disk
+        warm = cache.search(BBOX, start, end)
+        check(cache.api_searches == 1, "warm search called the API")
+        check([i.id for i in warm] == [i.id for i in cold], "warm items differ")
+
+        # a new cache on the same directory reads what the first one wrote
+        reopened = StacSearchCache(cache_dir, client=client)
+        reopened.search(BBOX, start, end)
+        check(reopened.api_searches == 0, "reopened cache called the API")
+
+        # extended: only from the newest cached item on
+        new_end = start + timedelta(days=90)
+        extended = cache.search(BBOX, start, new_end)
+        check(cache.api_searches == 2, f"extension made {cache.api_searches - 1} calls")
+        newest = start + timedelta(days=60)
+        check(
+            client.searches[-1] == (newest, new_end),
+            f"extension searched {client.searches[-1]}",
+        )
+        check(len(extended) == 19, f"extended search returned {len(extended)} items")
+
+    print("StacSearchCache: cold, warm and extended searches behave as expected")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import multiprocessing
+import os
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    # SimpleHTTPRequestHandler ignores Range headers, which GDAL needs for COGs
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+        range_header = self.headers.get("Range")
+        path = self.translate_path(self.path)
+        if range_header is None or not os.path.isfile(path):
+            return super().send_head()
+
+        file_size = os.path.getsize(path)
+        start, end = range_header.replace("bytes=", "").split("-")
+        start = int(start)
+        end = min(int(end) if end else file_size - 1, file_size - 1)
+
+        f = open(path, "rb")
+        f.seek(start)
+        self.send_response(206)
+        self.send_header("Content-Type", "image/tiff")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Range", f"bytes {start}-{end}/{file_size}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        self._range_remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        remaining = getattr(self, "_range_remaining", None)
+        if remaining is None:
+            return super().copyfile(source, outputfile)
+        outputfile.write(source.read(remaining))
+
+
+def _serve(directory, latency, conn) -> None:
+    handler = type(
+        "LatencyRangeRequestHandler", (RangeRequestHandler,), {"latency": latency}
+    )
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(handler, directory=directory)
+    )
+    conn.send(server.server_address)
+    server.serve_forever()
+
+
+class LocalHTTPServer:
+    """
+    Serves a directory over HTTP with range requests and optional per-request latency.
+    The server runs in its own process: rasterio.open holds the GIL while GDAL fetches
+    the header, which would deadlock a server thread in the same process.
+    """
+
+    def __init__(self, directory, latency=0.0):
+        self._directory = directory
+        self._latency = latency
+        self._process = None
+        self._address = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._address
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "LocalHTTPServer":
+        parent_conn, child_conn = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=_serve,
+            args=(self._directory, self._latency, child_conn),
+            daemon=True,
+        )
+        self._process.start()
+        self._address = parent_conn.recv()
+        return self
+
+    def __exit__(self, *exc):
+        self._process.terminate()
+        self._process.join()
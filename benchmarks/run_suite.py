@@ -0,0 +1,329 @@
+"""
+Times the hot paths on synthetic Sentinel-2 items (see synthetic_s2.py) for several
+AOI sizes, with the peak memory numpy allocates in each, and compares the results
+with a saved baseline.
+
+    python -m benchmarks.run_suite
+    python -m benchmarks.run_suite --aoi-px 200 600 --cases resample_bilinear compute_ndvi
+    python -m benchmarks.run_suite --save-baseline benchmarks/baseline.json
+
+Run from a clean tree before a change to save a baseline, and after it to compare.
+Memory peaks come from tracemalloc, so they include numpy arrays but not GDAL's
+own buffers.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+import numpy as np
+from rasterio.enums import Resampling
+
+from benchmarks.synthetic_s2 import bbox_for_aoi, make_synthetic_item
+from src.sentinel2_handling.base_classes.sentinel2_bands import Sentinel2L2ABands
+from src.sentinel2_handling.base_classes.spectral_indices import (
+    Sentinel2SpectralIndices,
+)
+from src.sentinel2_handling.sentinel2_downloader import filter_item_list
+from src.sentinel2_handling.stac_item_sentinel2_processor import (
+    StacItemSentinel2Processor,
+)
+from src.utils import img_utils
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+SIZE_10M = 2048
+FILTER_ITEMS = 4
+
+# each case takes the fixtures of one AOI size and returns the function to time
+CASES: Dict[str, Callable[[Dict], Callable[[], object]]] = {}
+
+
+def case(name):
+    def register(setup):
+        CASES[name] = setup
+        return setup
+
+    return register
+
+
+def _band(fx, band):
+    return fx["bands"][band]
+
+
+@case("load_and_clip_asset_10m")
+def _(fx):
+    proc = StacItemSentinel2Processor(item=fx["item"], bbox=fx["bbox"])
+    return lambda: proc._get_clipped_asset(Sentinel2L2ABands.Red)
+
+
+@case("load_and_clip_asset_20m")
+def _(fx):
+    proc = StacItemSentinel2Processor(item=fx["item"], bbox=fx["bbox"])
+    return lambda: proc._get_clipped_asset(Sentinel2L2ABands.SWIR1)
+
+
+@case("resample_bilinear")
+def _(fx):
+    swir, red = _band(fx, Sentinel2L2ABands.SWIR1), _band(fx, Sentinel2L2ABands.Red)
+    return lambda: swir.resample(red.img.shape, red.meta["transform"])
+
+
+@case("resample_nearest")
+def _(fx):
+    scl, red = _band(fx, Sentinel2L2ABands.SCL), _band(fx, Sentinel2L2ABands.Red)
+    return lambda: scl.resample(
+        red.img.shape, red.meta["transform"], resampling=Resampling.nearest
+    )
+
+
+@case("compute_cloud_mask")
+def _(fx):
+    scl, red = _band(fx, Sentinel2L2ABands.SCL), _band(fx, Sentinel2L2ABands.Red)
+    return lambda: Sentinel2SpectralIndices.compute_cloud_mask(
+        scl_raster=scl, ref_raster=red, resample_to_ref=True
+    )
+
+
+@case("compute_packed_cloud_mask")
+def _(fx):
+    scl, red = _band(fx, Sentinel2L2ABands.SCL), _band(fx, Sentinel2L2ABands.Red)
+    return lambda: Sentinel2SpectralIndices.compute_packed_cloud_mask(
+        scl_raster=scl, ref_raster=red, resample_to_ref=True
+    )
+
+
+@case("compute_rgb_image")
+def _(fx):
+    bands = [
+        _band(fx, b)
+        for b in (
+            Sentinel2L2ABands.Red,
+            Sentinel2L2ABands.Green,
+            Sentinel2L2ABands.Blue,
+        )
+    ]
+    return lambda: Sentinel2SpectralIndices.compute_rgb_image(*bands)
+
+
+@case("compute_ndvi")
+def _(fx):
+    nir, red = _band(fx, Sentinel2L2ABands.NIR), _band(fx, Sentinel2L2ABands.Red)
+    return lambda: Sentinel2SpectralIndices.compute_ndvi(nir, red)
+
+
+@case("compute_savi")
+def _(fx):
+    nir, red = _band(fx, Sentinel2L2ABands.NIR), _band(fx, Sentinel2L2ABands.Red)
+    return lambda: Sentinel2SpectralIndices.compute_savi(nir, red)
+
+
+@case("compute_bsi")
+def _(fx):
+    bands = [
+        _band(fx, b)
+        for b in (
+            Sentinel2L2ABands.NIR,
+            Sentinel2L2ABands.Red,
+            Sentinel2L2ABands.Blue,
+            Sentinel2L2ABands.SWIR1,
+        )
+    ]
+    return lambda: Sentinel2SpectralIndices.compute_bsi(*bands)
+
+
+@case("compute_ndmi")
+def _(fx):
+    nir, swir = _band(fx, Sentinel2L2ABands.NIR), _band(fx, Sentinel2L2ABands.SWIR1)
+    return lambda: Sentinel2SpectralIndices.compute_ndmi(nir, swir)
+
+
+@case("compute_fused_indices")
+def _(fx):
+    # a new instance per call, as results are memoized; all four in one fused pass
+    return lambda: Sentinel2SpectralIndices(loaded_bands=fx["bands"]).compute(
+        "ndvi", "savi", "bsi", "ndmi"
+    )
+
+
+@case("compute_usable_pixels")
+def _(fx):
+    # a new processor per call, so the SCL read is included as in screening
+    return lambda: StacItemSentinel2Processor(
+        item=fx["item"], bbox=fx["bbox"]
+    ).compute_usable_pixels()
+
+
+@case("filter_item_list")
+def _(fx):
+    def run():
+        # njobs=1 times the screening itself rather than worker start-up
+        with contextlib.redirect_stdout(io.StringIO()):
+            return filter_item_list(fx["items"], fx["bbox"], min_usable_pct=0, njobs=1)
+
+    return run
+
+
+@case("img_normalize_image")
+def _(fx):
+    return lambda: img_utils.normalize_image(fx["display"])
+
+
+@case("img_convert_to_uint8")
+def _(fx):
+    return lambda: img_utils.convert_to_uint8(fx["display"])
+
+
+@case("img_adjust_contrast_brightness")
+def _(fx):
+    return lambda: img_utils.adjust_contrast_brightness(fx["display"], 1.2, 0.05)
+
+
+@case("img_apply_histogram_equalization")
+def _(fx):
+    return lambda: img_utils.apply_histogram_equalization(fx["display"])
+
+
+@case("img_apply_clahe")
+def _(fx):
+    return lambda: img_utils.apply_clahe(fx["display"])
+
+
+@case("img_match_images")
+def _(fx):
+    img = img_utils.convert_to_uint8(fx["display"])
+    return lambda: img_utils.match_images(img[::-1], img)
+
+
+@case("img_histogram_matcher")
+def _(fx):
+    img = img_utils.convert_to_uint8(fx["display"])
+    matcher = img_utils.HistogramMatcher(img[::-1])
+    return lambda: matcher.match(img)
+
+
+@case("img_enhancement_pipeline")
+def _(fx):
+    pipeline = (
+        img_utils.EnhancementPipeline()
+        .normalize()
+        .clahe()
+        .contrast_brightness(1.2, 0.05)
+    )
+    return lambda: pipeline.run(fx["display"])
+
+
+def make_fixtures(data_dir, aoi_px) -> Dict:
+    items = [
+        make_synthetic_item(
+            data_dir, item_id=f"S2_SYNTHETIC_{seed}", size_10m=SIZE_10M, seed=seed
+        )
+        for seed in range(FILTER_ITEMS)
+    ]
+    bbox = bbox_for_aoi(aoi_px, size_10m=SIZE_10M)
+    proc = StacItemSentinel2Processor(item=items[0], bbox=bbox)
+    proc._load_and_clip_required_assets()
+    rgb = proc.load_and_compute_spectral_indices().rgb_image
+    return {
+        "items": items,
+        "item": items[0],
+        "bbox": bbox,
+        "bands": proc.s2_bands,
+        # h x w x 3 floats in [0, 1], what the img_utils functions get in notebooks
+        "display": img_utils.normalize_image(rgb.display_img.astype(np.float32)),
+    }
+
+
+def time_case(fn, repeats) -> Dict[str, float]:
+    # pixels outside the AOI are 0 in every band, so index ratios divide 0 by 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return _time_case(fn, repeats)
+
+
+def _time_case(fn, repeats) -> Dict[str, float]:
+    fn()  # warm up caches, lazy imports and GDAL's block cache
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "seconds": min(times),
+        "median_seconds": float(np.median(times)),
+        "peak_mb": peak / 2**20,
+    }
+
+
+def run_suite(aoi_sizes: List[int], case_names: List[str], repeats: int) -> Dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as data_dir:
+        for aoi_px in aoi_sizes:
+            fixtures = make_fixtures(data_dir, aoi_px)
+            for name in case_names:
+                key = f"{name}@{aoi_px}"
+                results[key] = time_case(CASES[name](fixtures), repeats)
+                print(
+                    f"{key:45s} {results[key]['seconds'] * 1000:9.2f} ms"
+                    f" {results[key]['peak_mb']:9.1f} MB"
+                )
+    return results
+
+
+def compare(results: Dict, baseline: Dict) -> None:
+    print(f"\ncompared with baseline from {baseline['created']}:")
+    for key, res in results.items():
+        base = baseline["results"].get(key)
+        if base is None:
+            print(f"{key:45s} not in the baseline")
+            continue
+        speedup = base["seconds"] / res["seconds"]
+        memory = res["peak_mb"] - base["peak_mb"]
+        print(f"{key:45s} {speedup:6.2f}x speed {memory:+9.1f} MB peak")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--aoi-px", type=int, nargs="+", default=[200, 600, 1200])
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES))
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = run_suite(args.aoi_px, args.cases, args.repeats)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(
+                {
+                    "created": time.strftime("%Y-%m-%d"),
+                    "machine": {
+                        "python": platform.python_version(),
+                        "platform": platform.platform(),
+                        "cpus": os.cpu_count(),
+                    },
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
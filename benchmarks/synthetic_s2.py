@@ -0,0 +1,153 @@
+import os
+from datetime import datetime
+from typing import List, Optional
+
+import numpy as np
+import pystac
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.warp import transform
+
+# a UTM 48N tile origin close to Singapore
+TILE_CRS = "EPSG:32648"
+TILE_ORIGIN = (300000.0, 200040.0)
+
+BANDS_10M = ["B02", "B03", "B04", "B08"]
+BANDS_20M = ["B11"]
+
+
+def write_cog(
+    path, img, res, nodata=0, blocksize=512, overview_factors=(2, 4, 8)
+) -> None:
+    height, width = img.shape
+    profile = {
+        "driver": "GTiff",
+        "height": height,
+        "width": width,
+        "count": 1,
+        "dtype": str(img.dtype),
+        "crs": TILE_CRS,
+        "transform": from_origin(*TILE_ORIGIN, res, res),
+        "nodata": nodata,
+        "tiled": True,
+        "blockxsize": blocksize,
+        "blockysize": blocksize,
+        "compress": "deflate",
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(img, 1)
+        if overview_factors:
+            dst.build_overviews(list(overview_factors), Resampling.nearest)
+
+
+# land cover classes and their share of the cloud free part of a scene:
+# vegetation, not vegetated, water, unclassified, dark area, saturated
+SCL_LAND_COVER = {4: 0.55, 5: 0.2, 6: 0.12, 7: 0.08, 2: 0.04, 1: 0.01}
+
+
+def make_scl(shape, rng, patch_px=16) -> np.ndarray:
+    """
+    SCL with spatially coherent classes: land cover in patch_px square patches,
+    a thin cirrus band (10), and clouds with a high probability core (9), a medium
+    probability fringe (8) and a displaced shadow (3).
+    """
+    height, width = shape
+    patches = rng.choice(
+        list(SCL_LAND_COVER),
+        size=(-(-height // patch_px), -(-width // patch_px)),
+        p=list(SCL_LAND_COVER.values()),
+    )
+    scl = np.repeat(np.repeat(patches, patch_px, 0), patch_px, 1)[:height, :width]
+    scl = scl.astype(np.uint8)
+
+    rows, cols = np.ogrid[:height, :width]
+    slope, offset = rng.uniform(-1, 1), rng.integers(0, height)
+    scl[np.abs(rows - slope * cols - offset) < height / 80] = 10
+
+    clouds = []
+    for _ in range(4):
+        r, c = rng.integers(0, height), rng.integers(0, width)
+        radius = rng.integers(height // 20, height // 6)
+        clouds.append((r, c, radius))
+        # shadows fall to the side of the cloud and are partly hidden by it
+        dist2 = (rows - r - radius // 2) ** 2 + (cols - c - radius // 2) ** 2
+        scl[dist2 < radius**2] = 3
+    for r, c, radius in clouds:
+        dist2 = (rows - r) ** 2 + (cols - c) ** 2
+        scl[dist2 < (1.2 * radius) ** 2] = 8
+        scl[dist2 < radius**2] = 9
+    return scl
+
+
+def make_synthetic_item(
+    out_dir,
+    item_id="S2_SYNTHETIC",
+    size_10m=2048,
+    seed=0,
+    href_prefix=None,
+    date=datetime(2024, 1, 1),
+    bands: Optional[List[str]] = None,
+) -> pystac.Item:
+    """
+    Writes Sentinel-2 like COGs (10m bands, 20m bands and SCL) into out_dir and returns
+    a STAC item pointing at them. href_prefix replaces out_dir in the asset hrefs, e.g.
+    to serve the files over HTTP. bands limits the assets to those named, e.g. ["SCL"]
+    for screening full size tiles without writing every band.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    size_20m = size_10m // 2
+
+    wanted = set(BANDS_10M + BANDS_20M + ["SCL"] if bands is None else bands)
+
+    arrays = {}
+    for band in BANDS_10M:
+        if band in wanted:
+            arrays[band] = (
+                rng.integers(1, 10000, (size_10m, size_10m), dtype=np.uint16),
+                10,
+            )
+    for band in BANDS_20M:
+        if band in wanted:
+            arrays[band] = (
+                rng.integers(1, 10000, (size_20m, size_20m), dtype=np.uint16),
+                20,
+            )
+    if "SCL" in wanted:
+        arrays["SCL"] = (make_scl((size_20m, size_20m), rng), 20)
+
+    item = pystac.Item(
+        id=item_id,
+        geometry=None,
+        bbox=None,
+        datetime=date,
+        properties={
+            # like items from a STAC API, which carry datetime in their properties
+            "datetime": date.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "eo:cloud_cover": 10.0,
+            "proj:epsg": int(TILE_CRS.split(":")[1]),
+        },
+    )
+    for band, (img, res) in arrays.items():
+        filename = f"{item_id}_{band}.tif"
+        path = os.path.join(out_dir, filename)
+        if not os.path.exists(path):
+            write_cog(path, img, res)
+        href = path if href_prefix is None else f"{href_prefix}/{filename}"
+        item.add_asset(band, pystac.Asset(href=href, media_type=pystac.MediaType.COG))
+    return item
+
+
+def bbox_for_aoi(size_px: int, size_10m=2048) -> List[float]:
+    # EPSG:4326 bbox of a square AOI of size_px 10m pixels in the middle of the tile
+    x_centre = TILE_ORIGIN[0] + size_10m * 10 / 2
+    y_centre = TILE_ORIGIN[1] - size_10m * 10 / 2
+    half = size_px * 10 / 2
+    (left, right), (bottom, top) = transform(
+        TILE_CRS,
+        "EPSG:4326",
+        [x_centre - half, x_centre + half],
+        [y_centre - half, y_centre + half],
+    )
+    return [left, bottom, right, top]
@@ -0,0 +1,103 @@
+import math
+from collections import namedtuple
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.errors import WindowError
+from rasterio.features import geometry_window
+from rasterio.warp import transform_bounds, transform_geom
+from rasterio.windows import Window, from_bounds
+from shapely.geometry import box, mapping, shape
+
+# the parts of a dataset geometry_window looks at
+_Grid = namedtuple("_Grid", ["transform", "width", "height"])
+
+
+class AOI:
+    """
+    Area of interest given as a bbox, shared by every item and band that clips to
+    it. The box reprojected to each CRS, and the pixel window it covers on each
+    grid, are computed once. Reprojection goes through rasterio (PROJ), so no
+    GeoDataFrame is needed.
+
+    Use AOI.from_bbox to get the process-wide instance for a bbox.
+    """
+
+    def __init__(self, bbox, crs="EPSG:4326"):
+        if len(bbox) != 4:
+            raise ValueError("Nope. the bbox should be a 4 tuple.")
+        self.bbox = tuple(float(v) for v in bbox)
+        self.crs = CRS.from_user_input(crs)
+        self._geometries: Dict[CRS, object] = {}
+        self._bounds: Dict[CRS, Tuple[float, float, float, float]] = {}
+        self._windows: Dict[Tuple, Window] = {}
+
+    @classmethod
+    def from_bbox(cls, bbox, crs="EPSG:4326") -> "AOI":
+        return _shared_aoi(tuple(float(v) for v in bbox), str(crs))
+
+    def __reduce__(self):
+        # unpickles to the shared instance of the receiving process
+        return (_shared_aoi, (self.bbox, self.crs.to_string()))
+
+    def geometry(self, crs):
+        """The bbox polygon in crs (a shapely geometry), corners reprojected."""
+        crs = CRS.from_user_input(crs)
+        if crs not in self._geometries:
+            geometry = box(*self.bbox)
+            if crs != self.crs:
+                geometry = shape(transform_geom(self.crs, crs, mapping(geometry)))
+            self._geometries[crs] = geometry
+        return self._geometries[crs]
+
+    def shapes(self, crs) -> List:
+        return [self.geometry(crs)]
+
+    def bounds(self, crs) -> Tuple[float, float, float, float]:
+        """Bounds in crs of the densified bbox edges, like transform_bounds."""
+        crs = CRS.from_user_input(crs)
+        if crs not in self._bounds:
+            if crs == self.crs:
+                self._bounds[crs] = self.bbox
+            else:
+                self._bounds[crs] = transform_bounds(self.crs, crs, *self.bbox)
+        return self._bounds[crs]
+
+    def window(self, crs, transform: Affine, width: int, height: int) -> Window:
+        """
+        Window of the grid covered by the polygon, same as geometry_window on a
+        dataset with that grid.
+        """
+        crs = CRS.from_user_input(crs)
+        key = ("geometry", crs, tuple(transform)[:6], width, height)
+        if key not in self._windows:
+            grid = _Grid(transform, width, height)
+            try:
+                self._windows[key] = geometry_window(grid, self.shapes(crs))
+            except WindowError:
+                raise ValueError("Input shapes do not overlap raster.")
+        return self._windows[key]
+
+    def bounds_window(self, crs, transform: Affine, width: int, height: int) -> Window:
+        """Whole-pixel window of the grid covering bounds(crs), clipped to the grid."""
+        crs = CRS.from_user_input(crs)
+        key = ("bounds", crs, tuple(transform)[:6], width, height)
+        if key not in self._windows:
+            window = from_bounds(*self.bounds(crs), transform=transform)
+            row_start = max(math.floor(window.row_off), 0)
+            col_start = max(math.floor(window.col_off), 0)
+            row_stop = min(math.ceil(window.row_off + window.height), height)
+            col_stop = min(math.ceil(window.col_off + window.width), width)
+            if row_stop <= row_start or col_stop <= col_start:
+                raise ValueError("Input shapes do not overlap raster.")
+            self._windows[key] = Window(
+                col_start, row_start, col_stop - col_start, row_stop - row_start
+            )
+        return self._windows[key]
+
+
+@lru_cache(maxsize=256)
+def _shared_aoi(bbox: Tuple[float, ...], crs: str) -> AOI:
+    return AOI(bbox, crs)
@@ -0,0 +1,134 @@
+from typing import Dict, Iterable, List, Optional, Type
+
+import numpy as np
+
+from src.sentinel2_handling.base_classes.raster import Raster
+from src.sentinel2_handling.base_classes.sentinel2_bands import Sentinel2L2ABands
+
+SAVI_L_FACTOR = 0.5
+
+# bands each index is computed from. NIR is always there and defines the 10m grid.
+INDEX_INPUTS = {
+    "ndvi": [Sentinel2L2ABands.NIR, Sentinel2L2ABands.Red],
+    "bsi": [
+        Sentinel2L2ABands.NIR,
+        Sentinel2L2ABands.SWIR1,
+        Sentinel2L2ABands.Red,
+        Sentinel2L2ABands.Blue,
+    ],
+    "ndmi": [Sentinel2L2ABands.NIR, Sentinel2L2ABands.SWIR1],
+    "savi": [Sentinel2L2ABands.NIR, Sentinel2L2ABands.Red],
+}
+INDEX_BAND_NAMES = {
+    "ndvi": "NDVI",
+    "bsi": "Bare Soil Index",
+    "ndmi": "NDMI",
+    "savi": "SAVI",
+}
+
+
+def required_bands(indices: Iterable[str]) -> List[Sentinel2L2ABands]:
+    bands = []
+    for name in indices:
+        for band in INDEX_INPUTS[name]:
+            if band not in bands:
+                bands.append(band)
+    return bands
+
+
+def compute_index_chunk(
+    bands: Dict[Sentinel2L2ABands, np.ndarray], outputs: Dict[str, np.ndarray]
+) -> None:
+    """
+    Computes every index in outputs from float band arrays of the same shape, writing
+    in place. Intermediates are only as large as the chunk.
+    """
+    nir = bands[Sentinel2L2ABands.NIR]
+    red = bands.get(Sentinel2L2ABands.Red)
+    blue = bands.get(Sentinel2L2ABands.Blue)
+    swir = bands.get(Sentinel2L2ABands.SWIR1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if "ndvi" in outputs or "savi" in outputs:
+            nir_minus_red = nir - red
+            nir_plus_red = nir + red
+            if "ndvi" in outputs:
+                np.divide(nir_minus_red, nir_plus_red, out=outputs["ndvi"])
+            if "savi" in outputs:
+                nir_minus_red *= 1 + SAVI_L_FACTOR
+                nir_plus_red += SAVI_L_FACTOR
+                np.divide(nir_minus_red, nir_plus_red, out=outputs["savi"])
+
+        if "ndmi" in outputs:
+            np.divide(nir - swir, nir + swir, out=outputs["ndmi"])
+
+        if "bsi" in outputs:
+            soil_refl = swir + red
+            veg_refl = nir + blue
+            np.divide(soil_refl - veg_refl, soil_refl + veg_refl, out=outputs["bsi"])
+
+
+class FusedIndexEngine:
+    """
+    Computes several spectral indices in one pass. Each 20m band is upsampled to the
+    10m grid once, and the indices are computed together in row chunks that fit in
+    cache, so no full-size float64 intermediates are allocated.
+    """
+
+    CHUNK_BYTES = 256 * 1024  # per input array, roughly an L2 cache
+
+    def __init__(
+        self,
+        indices: Iterable[str] = tuple(INDEX_INPUTS),
+        dtype: Type[np.floating] = np.float32,
+        chunk_rows: Optional[int] = None,
+    ):
+        self.indices = list(indices)
+        unknown = set(self.indices) - set(INDEX_INPUTS)
+        if unknown:
+            raise ValueError(f"Unknown spectral indices: {sorted(unknown)}")
+        self.dtype = np.dtype(dtype)
+        self.chunk_rows = chunk_rows
+
+    def _chunk_rows(self, width: int) -> int:
+        if self.chunk_rows is not None:
+            return self.chunk_rows
+        return max(1, self.CHUNK_BYTES // (width * self.dtype.itemsize))
+
+    def compute(
+        self, loaded_bands: Dict[Sentinel2L2ABands, Raster]
+    ) -> Dict[str, Raster]:
+        ref_raster = loaded_bands[Sentinel2L2ABands.NIR]
+        ref_shape = ref_raster.img.shape
+        ref_transform = ref_raster.meta["transform"]
+
+        # bring every input onto the 10m grid, once
+        inputs = {}
+        for band in required_bands(self.indices):
+            raster = loaded_bands[band]
+            if (
+                raster.img.shape != ref_shape
+                or raster.meta["transform"] != ref_transform
+            ):
+                raster = raster.resample(
+                    target_shape=ref_shape, target_affine_transform=ref_transform
+                )
+            inputs[band] = raster.img
+
+        outputs = {name: np.empty(ref_shape, dtype=self.dtype) for name in self.indices}
+        chunk_rows = self._chunk_rows(ref_shape[1])
+        for row_start in range(0, ref_shape[0], chunk_rows):
+            rows = slice(row_start, row_start + chunk_rows)
+            compute_index_chunk(
+                bands={
+                    band: img[rows].astype(self.dtype) for band, img in inputs.items()
+                },
+                outputs={name: out[rows] for name, out in outputs.items()},
+            )
+
+        meta = ref_raster.meta.copy()
+        meta["dtype"] = self.dtype.name
+        return {
+            name: Raster(img=img, meta=meta.copy(), band_names=[INDEX_BAND_NAMES[name]])
+            for name, img in outputs.items()
+        }
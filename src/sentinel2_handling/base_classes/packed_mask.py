@@ -0,0 +1,128 @@
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+from rasterio.windows import Window
+
+from src.sentinel2_handling.base_classes.raster import Raster
+
+# set bits per byte value
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class PackedMask:
+    """
+    Boolean h x w mask stored one bit per pixel (np.packbits along rows), 8x
+    smaller than a uint8 mask. Each row is padded to whole bytes, and padding
+    bits are always 0, so counts can popcount whole rows.
+
+    For cloud masks a set bit is a pixel that is not usable.
+    """
+
+    def __init__(
+        self, packed: np.ndarray, shape: Tuple[int, int], meta: Optional[Dict] = None
+    ):
+        height, width = shape
+        if packed.shape != (height, (width + 7) // 8) or packed.dtype != np.uint8:
+            raise ValueError("packed should be h x ceil(w / 8) uint8.")
+        self.packed = packed
+        self.shape = (height, width)
+        self.meta = meta
+
+    @classmethod
+    def from_array(cls, mask: np.ndarray, meta: Optional[Dict] = None) -> "PackedMask":
+        # anything non-zero is set
+        return cls(np.packbits(mask != 0, axis=1), mask.shape, meta)
+
+    @classmethod
+    def from_raster(cls, raster: Raster) -> "PackedMask":
+        if raster.num_bands != 1:
+            raise ValueError("Only single band rasters can be packed.")
+        img = np.asarray(raster.img)
+        return cls.from_array(img.reshape(raster.spatial_shape), meta=raster.meta)
+
+    @property
+    def size(self) -> int:
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def nbytes(self) -> int:
+        return self.packed.nbytes
+
+    def _window_bytes(self, window: Optional[Window]):
+        # packed bytes covering the window, and the bit offset of its first column
+        if window is None:
+            return self.packed, 0, self.shape[1]
+        rows, cols = window.toslices()
+        col_start, col_stop, _ = cols.indices(self.shape[1])
+        sub = self.packed[rows, col_start // 8 : (col_stop + 7) // 8]
+        return sub, col_start % 8, col_stop - col_start
+
+    def unpack(self, window: Optional[Window] = None) -> np.ndarray:
+        """The mask, or a window of it, as a bool array."""
+        sub, offset, width = self._window_bytes(window)
+        bits = np.unpackbits(sub, axis=1, count=offset + width)
+        return bits[:, offset:].view(bool)
+
+    def count(self, window: Optional[Window] = None) -> int:
+        """Number of set pixels, in the whole mask or a window."""
+        sub, offset, width = self._window_bytes(window)
+        if offset == 0 and (width % 8 == 0 or window is None):
+            return int(_POPCOUNT[sub].sum(dtype=np.int64))
+        return int(self.unpack(window).sum())
+
+    def fraction(self, window: Optional[Window] = None) -> float:
+        if window is None:
+            return self.count() / self.size
+        return self.count(window) / (window.width * window.height)
+
+    def clear_pct(self, window: Optional[Window] = None) -> float:
+        """Percentage of pixels that are not set, i.e. usable for a cloud mask."""
+        size = self.size if window is None else window.width * window.height
+        return (size - self.count(window)) / size * 100
+
+    def _check_same_shape(self, other: "PackedMask") -> None:
+        if self.shape != other.shape:
+            raise ValueError("Masks should have the same shape.")
+
+    def __and__(self, other: "PackedMask") -> "PackedMask":
+        self._check_same_shape(other)
+        return PackedMask(self.packed & other.packed, self.shape, self.meta)
+
+    def __or__(self, other: "PackedMask") -> "PackedMask":
+        self._check_same_shape(other)
+        return PackedMask(self.packed | other.packed, self.shape, self.meta)
+
+    def __invert__(self) -> "PackedMask":
+        inverted = ~self.packed
+        padding = (-self.shape[1]) % 8
+        if padding:
+            inverted[:, -1] &= np.uint8((0xFF << padding) & 0xFF)
+        return PackedMask(inverted, self.shape, self.meta)
+
+    @staticmethod
+    def all_of(masks: Iterable["PackedMask"]) -> "PackedMask":
+        """Set where every mask is set, e.g. pixels cloudy on every date."""
+        masks = list(masks)
+        for mask in masks[1:]:
+            masks[0]._check_same_shape(mask)
+        packed = np.bitwise_and.reduce([mask.packed for mask in masks])
+        return PackedMask(packed, masks[0].shape, masks[0].meta)
+
+    @staticmethod
+    def any_of(masks: Iterable["PackedMask"]) -> "PackedMask":
+        """Set where any mask is set."""
+        masks = list(masks)
+        for mask in masks[1:]:
+            masks[0]._check_same_shape(mask)
+        packed = np.bitwise_or.reduce([mask.packed for mask in masks])
+        return PackedMask(packed, masks[0].shape, masks[0].meta)
+
+    def to_raster(self, band_name="CloudMask (SCL)") -> Raster:
+        # unpacked as a 0/1 uint8 raster, e.g. for display or to_file
+        if self.meta is None:
+            raise ValueError("The mask has no meta to build a Raster from.")
+        meta = self.meta.copy()
+        meta.update({"dtype": "uint8", "nodata": None, "count": 1})
+        return Raster(
+            img=self.unpack().view(np.uint8), meta=meta, band_names=[band_name]
+        )
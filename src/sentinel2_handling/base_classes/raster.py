@@ -1,23 +1,141 @@
+import json
 from dataclasses import dataclass, field
-from typing import Dict, List, Optional, Type
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Type
 
-import geopandas as gpd
 import numpy as np
 import rasterio
-from shapely import box
+import rasterio.warp
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+from rasterio.windows import transform as window_transform
+
+from src.sentinel2_handling import instrumentation
+from src.sentinel2_handling.base_classes.aoi import AOI
+from src.sentinel2_handling.base_classes.resample_plans import (
+    apply_plan,
+    resample_plans,
+)
+
+if TYPE_CHECKING:
+    from src.sentinel2_handling.base_classes.shared_raster import SharedRasterDescriptor
+
+
+def meta_to_json(meta: Dict) -> str:
+    meta = meta.copy()
+    if meta.get("crs") is not None:
+        meta["crs"] = CRS.from_user_input(meta["crs"]).to_wkt()
+    if meta.get("transform") is not None:
+        meta["transform"] = list(meta["transform"])[:6]
+    return json.dumps(meta)
+
+
+def meta_from_json(meta_json: str) -> Dict:
+    meta = json.loads(meta_json)
+    if meta.get("crs") is not None:
+        meta["crs"] = CRS.from_wkt(meta["crs"])
+    if meta.get("transform") is not None:
+        meta["transform"] = Affine(*meta["transform"])
+    return meta
+
+
+class LazyDatasetArray:
+    """
+    Array-like view of a GeoTIFF laid out like Raster.img (num_bands x h x w when
+    band_first, else h x w x num_bands). Slicing reads only the requested window;
+    converting to a numpy array reads everything.
+    """
+
+    def __init__(self, path, band_first=False):
+        self.path = path
+        self.band_first = band_first
+        with rasterio.open(path) as src:
+            self.dtype = np.dtype(src.dtypes[0])
+            self._count = src.count
+            self._spatial_shape = (src.height, src.width)
+        if band_first:
+            self.shape = (self._count,) + self._spatial_shape
+        else:
+            self.shape = self._spatial_shape + (self._count,)
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def size(self) -> int:
+        return int(np.prod(self.shape))
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (self.ndim - len(key))
+        if self.band_first:
+            band_key, row_key, col_key = key
+        else:
+            row_key, col_key, band_key = key
+
+        # rows and columns become the read window, what is left is applied by numpy
+        spans = []
+        local_key = []
+        for k, size in zip((row_key, col_key), self._spatial_shape):
+            if isinstance(k, (int, np.integer)):
+                k = int(k) % size
+                spans.append((k, k + 1))
+                local_key.append(0)
+            elif isinstance(k, slice) and (k.step is None or k.step > 0):
+                start, stop, step = k.indices(size)
+                spans.append((start, max(start, stop)))
+                local_key.append(slice(None, None, step))
+            else:
+                # fancy indexing or negative steps: read the whole extent
+                spans.append((0, size))
+                local_key.append(k)
+
+        indexes = list(range(1, self._count + 1))
+        if isinstance(band_key, (int, np.integer)):
+            indexes = [int(band_key) % self._count + 1]
+            band_key = 0
+
+        (row_start, row_stop), (col_start, col_stop) = spans
+        window = Window(
+            col_start, row_start, col_stop - col_start, row_stop - row_start
+        )
+        with rasterio.open(self.path) as src:
+            data = src.read(indexes, window=window)
+        if self.band_first:
+            return data[(band_key, *local_key)]
+        return np.moveaxis(data, 0, -1)[(*local_key, band_key)]
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        data = self[:]
+        return data if dtype is None else data.astype(dtype)
+
+    # the ndarray methods Raster calls on img; both read the whole dataset
+    def copy(self) -> np.ndarray:
+        return np.asarray(self)
+
+    def astype(self, dtype) -> np.ndarray:
+        return np.asarray(self, dtype=dtype)
 
 
 @dataclass
 class Raster:
-    img: np.array  # assume that img.shape == h x w x num_bands
+    img: np.array  # h x w x num_bands, or num_bands x h x w if band_first
     meta: Dict
     band_names: Optional[List[str]] = field(default_factory=list)
+    # rasterio's native layout, so reads and writes need no transpose
+    band_first: bool = False
     num_bands: int = field(init=False)
 
     def __post_init__(self):
         # check img shape
         if len(self.img.shape) == 3:
-            self.num_bands = self.img.shape[-1]
+            self.num_bands = self.img.shape[0 if self.band_first else -1]
         elif len(self.img.shape) == 2:
             self.num_bands = 1
         else:
@@ -30,46 +148,185 @@ class Raster:
         if len(self.band_names) != self.num_bands:
             raise ValueError("Bad number band names.")
 
+    @property
+    def spatial_shape(self) -> Tuple[int, int]:
+        if len(self.img.shape) == 2:
+            return tuple(self.img.shape)
+        return tuple(self.img.shape[1:] if self.band_first else self.img.shape[:2])
+
+    @property
+    def bands(self) -> np.ndarray:
+        # num_bands x h x w view of img, as rasterio reads and writes it
+        img = np.asarray(self.img)
+        if img.ndim == 2:
+            return img[np.newaxis]
+        return img if self.band_first else np.moveaxis(img, -1, 0)
+
+    @property
+    def display_img(self) -> np.ndarray:
+        # h x w x num_bands view of img, for plotting and image processing
+        img = np.asarray(self.img)
+        if img.ndim == 2 or not self.band_first:
+            return img
+        return np.moveaxis(img, 0, -1)
+
     @classmethod
-    def load_from_tif(cls, path_to_geotiff) -> "Raster":
+    def load_from_tif(cls, path_to_geotiff, lazy=False, band_first=True) -> "Raster":
+        # lazy: back img by the file, so that slicing only reads that region
+        # band_first: keep rasterio's bands x h x w layout instead of transposing
         with rasterio.open(path_to_geotiff, "r") as src:
-            # Read all bands
-            image = src.read()
-            # Transpose to get (height, width, channels)
-            image = np.transpose(image, (1, 2, 0))
-            band_names = src.descriptions
+            band_names = list(src.descriptions)
             meta = src.meta
+            if not lazy:
+                # Read all bands
+                image = src.read()
+                if not band_first:
+                    # Transpose to get (height, width, channels)
+                    image = np.transpose(image, (1, 2, 0))
 
-        return Raster(img=image, meta=meta, band_names=band_names)
+        if lazy:
+            image = LazyDatasetArray(path_to_geotiff, band_first=band_first)
+        return Raster(
+            img=image, meta=meta, band_names=band_names, band_first=band_first
+        )
 
-    def clip_to_bbox(self, bbox: List, bbox_crs="EPSG:4326") -> "Raster":
-        clip_gdf = gpd.GeoDataFrame({"geometry": [box(*bbox)]}, crs=bbox_crs)
-        if clip_gdf.crs != self.meta["crs"]:
-            clip_gdf = clip_gdf.to_crs(self.meta["crs"])
+    @classmethod
+    def load_from_npy(cls, path, mmap_mode="r") -> "Raster":
+        # img is an np.memmap of the .npy file written by to_npy
+        image = np.load(path, mmap_mode=mmap_mode)
+        with open(path + ".json") as f:
+            sidecar = json.load(f)
+        return Raster(
+            img=image,
+            meta=meta_from_json(sidecar["meta"]),
+            band_names=sidecar["band_names"],
+            band_first=sidecar.get("band_first", False),
+        )
+
+    def to_npy(self, path) -> None:
+        # raw array + json sidecar, for memory mapping with load_from_npy
+        out = np.lib.format.open_memmap(
+            path, mode="w+", dtype=self.img.dtype, shape=self.img.shape
+        )
+        out[:] = self.img
+        out.flush()
+        del out
+        with open(path + ".json", "w") as f:
+            json.dump(
+                {
+                    "meta": meta_to_json(self.meta),
+                    "band_names": list(self.band_names),
+                    "band_first": self.band_first,
+                },
+                f,
+            )
+
+    def to_shared_memory(self) -> "SharedRasterDescriptor":
+        """
+        Copies img into a POSIX shared memory block, e.g. in a worker process. Only
+        the returned descriptor needs to be sent back; from_shared_memory views the
+        block without copying. The block lives until it is attached with unlink (the
+        default) or the descriptor is discarded.
+        """
+        from src.sentinel2_handling.base_classes.shared_raster import (
+            SharedRasterDescriptor,
+            share_array,
+        )
+
+        name, shape, dtype = share_array(np.asarray(self.img))
+        return SharedRasterDescriptor(
+            name=name,
+            shape=shape,
+            dtype=dtype,
+            meta=self.meta,
+            band_names=list(self.band_names),
+            band_first=self.band_first,
+        )
 
-        out_image, out_transform = rasterio.mask.mask(
-            self.img, clip_gdf.geometry, crop=True
+    @classmethod
+    def from_shared_memory(
+        cls, descriptor: "SharedRasterDescriptor", unlink=True
+    ) -> "Raster":
+        from src.sentinel2_handling.base_classes.shared_raster import attach_array
+
+        # img views the shared block, which is freed once img and its views are gone
+        image = attach_array(
+            descriptor.name, descriptor.shape, descriptor.dtype, unlink=unlink
+        )
+        return cls(
+            img=image,
+            meta=descriptor.meta,
+            band_names=list(descriptor.band_names),
+            band_first=descriptor.band_first,
         )
+
+    def clip_to_bbox(self, bbox: List, bbox_crs="EPSG:4326") -> "Raster":
+        # pure window slicing: img of the result is a view, not a copy
+        height, width = self.spatial_shape
+        window = AOI.from_bbox(bbox, bbox_crs).bounds_window(
+            self.meta["crs"], self.meta["transform"], width=width, height=height
+        )
+
+        rows, cols = window.toslices()
+        out_image = self.img[:, rows, cols] if self.band_first else self.img[rows, cols]
         out_meta = self.meta.copy()
         out_meta.update(
             {
-                "height": out_image.shape[0],
-                "width": out_image.shape[1],
-                "transform": out_transform,
+                "height": window.height,
+                "width": window.width,
+                "transform": window_transform(window, self.meta["transform"]),
             }
         )
-        return Raster(img=out_image, band_names=self.band_names, meta=out_meta)
+        return Raster(
+            img=out_image,
+            band_names=self.band_names,
+            meta=out_meta,
+            band_first=self.band_first,
+        )
 
-    def to_file(self, filename) -> None:
+    def to_file(
+        self,
+        filename,
+        cog=False,
+        compress: Optional[str] = None,
+        blocksize: Optional[int] = None,
+        overview_resampling: str = "nearest",
+    ) -> None:
+        """
+        cog: write a cloud optimized GeoTIFF (tiled, with overviews). Defaults to
+            deflate compression and 512 px tiles.
+        compress / blocksize: compression and square tile size for a plain GeoTIFF.
+        """
         # fix band count and datatype
         self.meta["count"] = self.num_bands
         self.meta["dtype"] = str(self.img.dtype)
 
-        with rasterio.open(filename, "w", **self.meta) as dst:
+        profile = self.meta.copy()
+        if cog:
+            profile.update(
+                {
+                    "driver": "COG",
+                    "compress": compress or "deflate",
+                    # horizontal / floating point differencing, picked per dtype
+                    "predictor": "YES",
+                    "blocksize": blocksize or 512,
+                    "overview_resampling": overview_resampling,
+                    "BIGTIFF": "IF_SAFER",
+                }
+            )
+        else:
+            if compress is not None:
+                profile["compress"] = compress
+            if blocksize is not None:
+                profile.update(
+                    {"tiled": True, "blockxsize": blocksize, "blockysize": blocksize}
+                )
+
+        # one multi-band write, in rasterio's bands x h x w order
+        with rasterio.open(filename, "w", **profile) as dst:
+            dst.write(self.bands)
             for b in range(self.num_bands):
-                band_num = b + 1
-                dst.write(self.img[:, :, b], band_num)
-                dst.set_band_description(band_num, self.band_names[b])
+                dst.set_band_description(b + 1, self.band_names[b])
 
     def binarize(self):
         out_img = self.img.copy()
@@ -78,30 +335,85 @@ class Raster:
         self.img = out_img
 
     def resample(
-        self, target_shape, target_affine_transform, band_names=None
+        self,
+        target_shape,
+        target_affine_transform,
+        band_names=None,
+        resampling=Resampling.bilinear,
     ) -> "Raster":
-        crs = self.meta["crs"]
-        out_image, _ = rasterio.warp.reproject(
-            self.img,
-            np.zeros(target_shape, dtype=self.img.dtype),
-            src_transform=self.meta["transform"],
-            src_crs=crs,
-            dst_transform=target_affine_transform,
-            dst_crs=crs,
-            resampling=rasterio.enums.Resampling.bilinear,
+        # target_shape is the (h, w) of the target grid. 3D shapes are read in this
+        # raster's layout. Use Resampling.nearest for categorical layers like SCL.
+        if len(target_shape) == 3:
+            target_shape = target_shape[1:] if self.band_first else target_shape[:2]
+        height, width = target_shape
+
+        plan = resample_plans.get(
+            self.meta["transform"],
+            self.spatial_shape,
+            target_affine_transform,
+            (height, width),
+            resampling,
         )
+        if plan is not None and self.img.dtype.kind == "f" and np.isnan(self.img).any():
+            plan = None  # GDAL skips NaNs, the plan would spread them
+
+        with instrumentation.stage("resample", method=resampling.name) as timed:
+            if plan is not None:
+                if len(self.img.shape) == 2:
+                    out_image = apply_plan(plan, np.asarray(self.img))
+                else:
+                    out_image = np.stack(
+                        [apply_plan(plan, band) for band in self.bands]
+                    )
+            else:
+                out_image = self._reproject(
+                    (height, width), target_affine_transform, resampling
+                )
+            timed.add(array_bytes=out_image.nbytes, planned=plan is not None)
+
+        if out_image.ndim == 3 and not self.band_first:
+            out_image = np.moveaxis(out_image, 0, -1)
         if band_names is None:
             band_names = self.band_names
 
         out_meta = self.meta.copy()
         out_meta.update(
             {
-                "height": out_image.shape[0],
-                "width": out_image.shape[1],
+                "height": height,
+                "width": width,
                 "transform": target_affine_transform,
             }
         )
-        return Raster(img=out_image, band_names=band_names, meta=out_meta)
+        return Raster(
+            img=out_image,
+            band_names=band_names,
+            meta=out_meta,
+            band_first=self.band_first,
+        )
+
+    def _reproject(self, target_shape, target_affine_transform, resampling):
+        height, width = target_shape
+        if len(self.img.shape) == 2:
+            source = self.img
+            destination = np.zeros((height, width), dtype=self.img.dtype)
+        else:
+            # reproject works band-first
+            source = self.bands
+            destination = np.zeros(
+                (self.num_bands, height, width), dtype=self.img.dtype
+            )
+
+        crs = self.meta["crs"]
+        out_image, _ = rasterio.warp.reproject(
+            source,
+            destination,
+            src_transform=self.meta["transform"],
+            src_crs=crs,
+            dst_transform=target_affine_transform,
+            dst_crs=crs,
+            resampling=resampling,
+        )
+        return out_image
 
     @classmethod
     def subtract_rasters(
@@ -116,7 +428,7 @@ class Raster:
 
         meta = raster_left.meta.copy()
         if new_dtype is None:
-            subtracted_img = raster_left.img - raster_right.img
+            subtracted_img = np.subtract(raster_left.img, raster_right.img)
         else:
             subtracted_img = raster_left.img.astype(new_dtype) - raster_right.img
             # Cast to the desired datatype
@@ -131,7 +443,9 @@ class Raster:
                 new_band_names.append(f"{n1} minus {n2}]")
 
         # Create the output raster
-        return cls(subtracted_img, meta, new_band_names)
+        return cls(
+            subtracted_img, meta, new_band_names, band_first=raster_left.band_first
+        )
 
     @classmethod
     def add_rasters(
@@ -146,7 +460,7 @@ class Raster:
 
         meta = raster_left.meta.copy()
         if new_dtype is None:
-            added_img = raster_left.img + raster_right.img
+            added_img = np.add(raster_left.img, raster_right.img)
         else:
             added_img = raster_left.img.astype(new_dtype) + raster_right.img
             # Cast to the desired datatype
@@ -161,7 +475,7 @@ class Raster:
                 new_band_names.append(f"{n1} plus {n2}")
 
         # Create the output raster
-        return cls(added_img, meta, new_band_names)
+        return cls(added_img, meta, new_band_names, band_first=raster_left.band_first)
 
     @classmethod
     def divide_rasters(
@@ -190,4 +504,6 @@ class Raster:
                 new_band_names.append(f"Division of {n1} by {n2}")
 
         # Create the output raster
-        return cls(divided_img, meta, new_band_names)
+        return cls(
+            divided_img, meta, new_band_names, band_first=raster_numerator.band_first
+        )
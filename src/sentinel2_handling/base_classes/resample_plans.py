@@ -0,0 +1,172 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import numpy as np
+from affine import Affine
+from rasterio.enums import Resampling
+
+MAX_CACHED_PLANS = 64
+
+
+@dataclass(frozen=True)
+class AxisPlan:
+    # for each output pixel along one axis: the two source pixels and the weight
+    # of the upper one. Output pixels whose centre is outside the source stay 0.
+    lower: np.ndarray
+    upper: np.ndarray
+    weight: np.ndarray
+    valid: np.ndarray
+
+
+@dataclass(frozen=True)
+class ResamplePlan:
+    rows: AxisPlan
+    cols: AxisPlan
+    method: Resampling
+
+
+def _axis_plan(
+    src_origin: float,
+    src_res: float,
+    src_size: int,
+    dst_origin: float,
+    dst_res: float,
+    dst_size: int,
+    method: Resampling,
+) -> AxisPlan:
+    centres = dst_origin + (np.arange(dst_size) + 0.5) * dst_res
+    coords = (centres - src_origin) / src_res  # in source pixels
+    valid = (coords >= 0) & (coords < src_size)
+
+    if method == Resampling.nearest:
+        lower = np.clip(np.floor(coords).astype(np.intp), 0, src_size - 1)
+        return AxisPlan(lower, lower, np.zeros(dst_size), valid)
+
+    # bilinear between the two nearest source pixel centres. At the edges GDAL
+    # uses the one pixel that exists.
+    coords -= 0.5
+    lower = np.floor(coords).astype(np.intp)
+    weight = coords - lower
+    upper = lower + 1
+    weight[lower < 0] = 1.0
+    weight[upper > src_size - 1] = 0.0
+    return AxisPlan(
+        np.clip(lower, 0, src_size - 1), np.clip(upper, 0, src_size - 1), weight, valid
+    )
+
+
+class ResamplePlanCache:
+    """
+    Precomputed resampling plans, keyed by source and destination grid and method.
+
+    Items over the same AOI and tile share grids, so the bilinear weights for e.g.
+    the 20m bands onto the 10m grid are computed once and applied with numpy
+    gathers for every item. Only plans for the same CRS, axis-aligned transforms
+    and bilinear upsampling or nearest are built; other cases return None and the
+    caller falls back to rasterio.warp.reproject. Results match GDAL's.
+    """
+
+    def __init__(self, max_plans: int = MAX_CACHED_PLANS):
+        self.max_plans = max_plans
+        self.hits = 0
+        self.misses = 0
+        self._plans: "OrderedDict[Tuple, Optional[ResamplePlan]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        src_transform: Affine,
+        src_shape: Tuple[int, int],
+        dst_transform: Affine,
+        dst_shape: Tuple[int, int],
+        method: Resampling,
+    ) -> Optional[ResamplePlan]:
+        key = (
+            tuple(src_transform)[:6],
+            tuple(src_shape),
+            tuple(dst_transform)[:6],
+            tuple(dst_shape),
+            method,
+        )
+        with self._lock:
+            if key in self._plans:
+                self.hits += 1
+                self._plans.move_to_end(key)
+                return self._plans[key]
+            self.misses += 1
+
+        plan = self._build(src_transform, src_shape, dst_transform, dst_shape, method)
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > self.max_plans:
+                self._plans.popitem(last=False)
+        return plan
+
+    @staticmethod
+    def _build(src_transform, src_shape, dst_transform, dst_shape, method):
+        if method not in (Resampling.bilinear, Resampling.nearest):
+            return None
+        if src_transform.b or src_transform.d or dst_transform.b or dst_transform.d:
+            return None
+        if method == Resampling.bilinear and (
+            abs(dst_transform.a) > abs(src_transform.a)
+            or abs(dst_transform.e) > abs(src_transform.e)
+        ):
+            # GDAL widens the kernel when downsampling
+            return None
+
+        rows = _axis_plan(
+            src_transform.f,
+            src_transform.e,
+            src_shape[0],
+            dst_transform.f,
+            dst_transform.e,
+            dst_shape[0],
+            method,
+        )
+        cols = _axis_plan(
+            src_transform.c,
+            src_transform.a,
+            src_shape[1],
+            dst_transform.c,
+            dst_transform.a,
+            dst_shape[1],
+            method,
+        )
+        return ResamplePlan(rows, cols, method)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._plans.clear()
+            self.hits = self.misses = 0
+
+
+def apply_plan(plan: ResamplePlan, img: np.ndarray) -> np.ndarray:
+    """Resamples one h x w band with a plan, in the band's dtype."""
+    rows, cols = plan.rows, plan.cols
+    if plan.method == Resampling.nearest:
+        out = np.take(np.take(img, rows.lower, axis=0), cols.lower, axis=1)
+    else:
+        top = np.take(img, rows.lower, axis=0).astype(np.float64)
+        diff = np.take(img, rows.upper, axis=0) - top
+        diff *= rows.weight[:, None]
+        top += diff
+        left = np.take(top, cols.lower, axis=1)
+        diff = np.take(top, cols.upper, axis=1)
+        diff -= left
+        diff *= cols.weight
+        left += diff
+        if img.dtype.kind in "ui":
+            # GDAL rounds half up
+            left += 0.5
+            np.floor(left, out=left)
+        out = left.astype(img.dtype)
+
+    out[~rows.valid] = 0
+    out[:, ~cols.valid] = 0
+    return out
+
+
+resample_plans = ResamplePlanCache()
@@ -0,0 +1,90 @@
+import os
+from dataclasses import dataclass
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+
+@dataclass(frozen=True)
+class SharedRasterDescriptor:
+    """
+    What crosses the process boundary instead of a Raster's pixels: the name of
+    the shared memory block holding img, and what is needed to view it again.
+    """
+
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+    meta: Dict
+    band_names: List[str]
+    band_first: bool
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+    def discard(self) -> None:
+        # for descriptors that will never be attached
+        unlink_block(self.name)
+
+
+class _AttachedBlock(shared_memory.SharedMemory):
+    # arrays viewing the block keep its mapping alive on their own, so it must not
+    # be closed when this object is collected before them
+    def __del__(self):
+        pass
+
+
+def _untrack(block: shared_memory.SharedMemory) -> None:
+    # before python 3.13 every process that opens a block registers it with its
+    # resource tracker, which unlinks it when that process exits. Ownership is
+    # handled explicitly here instead.
+    resource_tracker.unregister(block._name, "shared_memory")
+
+
+def share_array(img: np.ndarray) -> Tuple[str, Tuple[int, ...], str]:
+    """
+    Copies img into a new shared memory block and returns (name, shape, dtype).
+    The block outlives this process until attach_array(..., unlink=True) or
+    unlink_block is called on it.
+    """
+    block = shared_memory.SharedMemory(create=True, size=max(1, img.nbytes))
+    try:
+        np.ndarray(img.shape, dtype=img.dtype, buffer=block.buf)[...] = img
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+    _untrack(block)
+    block.close()
+    return block.name, tuple(img.shape), img.dtype.str
+
+
+def attach_array(name: str, shape, dtype, unlink=True) -> np.ndarray:
+    """
+    Array viewing the block without copying. With unlink, the name is removed
+    right away: nothing else can attach, and the memory is freed once the
+    returned array and all views of it are gone.
+    """
+    block = _AttachedBlock(name=name)
+    img = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    if unlink:
+        block.unlink()
+    else:
+        _untrack(block)
+    # the mapping does not need the descriptor, so don't hold one per array
+    if block._fd >= 0:
+        os.close(block._fd)
+        block._fd = -1
+    return img
+
+
+def unlink_block(name: str) -> None:
+    """Frees a block that will not be attached, e.g. when a batch is abandoned."""
+    try:
+        block = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    block.close()
+    block.unlink()
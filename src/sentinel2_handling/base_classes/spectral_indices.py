@@ -1,10 +1,24 @@
-from typing import Dict
+from typing import Callable, Dict, List, Optional, Type
 
 import numpy as np
 
+from src.sentinel2_handling import instrumentation
+from src.sentinel2_handling.base_classes.fused_indices import (
+    INDEX_INPUTS,
+    FusedIndexEngine,
+)
+from src.sentinel2_handling.base_classes.packed_mask import PackedMask
 from src.sentinel2_handling.base_classes.raster import Raster
 from src.sentinel2_handling.base_classes.sentinel2_bands import Sentinel2L2ABands
 
+# SCL classes that make a pixel unusable: no data, cloud shadow, cloud medium and
+# high probability, thin cirrus
+CLOUD_SCL_CLASSES = [0, 3, 8, 9, 10]
+
+
+def _result_nbytes(result) -> int:
+    return result.nbytes if isinstance(result, PackedMask) else result.img.nbytes
+
 
 # fmt: off
 class BaseSpectralIndices:
@@ -18,44 +32,138 @@ class BaseSpectralIndices:
 
 class Sentinel2SpectralIndices(BaseSpectralIndices):
     # upsampled BSI and NDMI to 10m.
-    loaded_bands: Dict[str, Raster]
+    # every attribute is computed on first access, loading only the bands it needs.
+    loaded_bands: Dict[Sentinel2L2ABands, Raster]
+
+    # bands behind each attribute. Red gives the 10m grid the cloud mask is upsampled to.
+    ATTRIBUTE_BANDS = {
+        "rgb_image": [Sentinel2L2ABands.Red, Sentinel2L2ABands.Green, Sentinel2L2ABands.Blue],
+        "cloud_mask": [Sentinel2L2ABands.SCL, Sentinel2L2ABands.Red],
+        "packed_cloud_mask": [Sentinel2L2ABands.SCL, Sentinel2L2ABands.Red],
+        **INDEX_INPUTS,
+    }
 
-    def __init__(self, loaded_bands: Dict[str, Raster], only_rgb = False):
+    def __init__(
+        self,
+        loaded_bands: Dict[Sentinel2L2ABands, Raster],
+        dtype: Type[np.floating] = np.float32,
+        band_loader: Optional[Callable[[List[Sentinel2L2ABands]], Dict[Sentinel2L2ABands, Raster]]] = None,
+        item_id: Optional[str] = None,
+    ):
+        """
+        loaded_bands: bands already available. Missing ones are fetched with band_loader.
+        band_loader: called with a list of bands, returns them as clipped rasters.
+        item_id: the item the bands come from, for instrumentation records.
+        """
         self.loaded_bands = loaded_bands
-        self.rgb_image = self.compute_rgb_image(
-            red_raster=loaded_bands.get(Sentinel2L2ABands.Red),
-            green_raster=loaded_bands.get(Sentinel2L2ABands.Green),
-            blue_raster=loaded_bands.get(Sentinel2L2ABands.Blue),
-        )
-        if not only_rgb:
-            self.cloud_mask = self.compute_cloud_mask(
-                scl_raster=loaded_bands.get(Sentinel2L2ABands.SCL),
-                ref_raster=loaded_bands.get(Sentinel2L2ABands.Red),
-                resample_to_ref=True,
-            )
-            self.ndvi = self.compute_ndvi(
-                nir_raster=loaded_bands.get(Sentinel2L2ABands.NIR),
-                red_raster=loaded_bands.get(Sentinel2L2ABands.Red),
-            )
-            self.bsi = self.compute_bsi(
-                nir_raster=loaded_bands.get(Sentinel2L2ABands.NIR),
-                swir_raster=loaded_bands.get(Sentinel2L2ABands.SWIR1),
-                red_raster=loaded_bands.get(Sentinel2L2ABands.Red),
-                blue_raster=loaded_bands.get(Sentinel2L2ABands.Blue),
-            )
-            self.ndmi = self.compute_ndmi(
-                nir_raster=loaded_bands.get(Sentinel2L2ABands.NIR),
-                swir_raster=loaded_bands.get(Sentinel2L2ABands.SWIR1),
+        self.dtype = dtype
+        self._band_loader = band_loader
+        self.item_id = item_id
+        self._results: Dict[str, Raster] = {}
+
+    @property
+    def rgb_image(self) -> Raster:
+        return self._get("rgb_image")
+
+    @property
+    def cloud_mask(self) -> Raster:
+        return self._get("cloud_mask")
+
+    @property
+    def packed_cloud_mask(self) -> PackedMask:
+        # cloud_mask at one bit per pixel, for keeping masks of many dates around
+        return self._get("packed_cloud_mask")
+
+    @property
+    def ndvi(self) -> Raster:
+        return self._get("ndvi")
+
+    @property
+    def bsi(self) -> Raster:
+        return self._get("bsi")
+
+    @property
+    def savi(self) -> Raster:
+        return self._get("savi")
+
+    @property
+    def ndmi(self) -> Raster:
+        return self._get("ndmi")
+
+    def _get(self, name: str) -> Raster:
+        if name not in self._results:
+            self.compute(name)
+        return self._results[name]
+
+    def _ensure_bands(self, bands: List[Sentinel2L2ABands]) -> None:
+        missing = [band for band in bands if band not in self.loaded_bands]
+        if not missing:
+            return
+        if self._band_loader is None:
+            raise ValueError(f"Bands {[b.value for b in missing]} are not loaded and there is no band loader.")
+        self.loaded_bands.update(self._band_loader(missing))
+
+    def compute(self, *names: str) -> None:
+        # computes (and memoizes) several attributes at once: their bands are loaded
+        # together and the spectral indices share a single fused pass.
+        names = [name for name in names if name not in self._results]
+        if not names:
+            return
+        unknown = set(names) - set(self.ATTRIBUTE_BANDS)
+        if unknown:
+            raise ValueError(f"Unknown attributes: {sorted(unknown)}")
+
+        required = []
+        for name in names:
+            required += [b for b in self.ATTRIBUTE_BANDS[name] if b not in required]
+        self._ensure_bands(required)
+
+        with instrumentation.scope(item=self.item_id), instrumentation.stage("indices", names=",".join(names)) as timed:
+            self._compute(names)
+            timed.add(array_bytes=sum(_result_nbytes(self._results[name]) for name in names))
+
+    def _compute(self, names: List[str]) -> None:
+        index_names = [name for name in names if name in INDEX_INPUTS]
+        if index_names:
+            self._results.update(FusedIndexEngine(indices=index_names, dtype=self.dtype).compute(self.loaded_bands))
+        if "rgb_image" in names:
+            self._results["rgb_image"] = self.compute_rgb_image(
+                red_raster=self.loaded_bands[Sentinel2L2ABands.Red],
+                green_raster=self.loaded_bands[Sentinel2L2ABands.Green],
+                blue_raster=self.loaded_bands[Sentinel2L2ABands.Blue],
             )
-            self.savi = self.compute_savi(
-                nir_raster=loaded_bands.get(Sentinel2L2ABands.NIR),
-                red_raster=loaded_bands.get(Sentinel2L2ABands.Red)
+        if "cloud_mask" in names:
+            self._results["cloud_mask"] = self.compute_cloud_mask(
+                scl_raster=self.loaded_bands[Sentinel2L2ABands.SCL],
+                ref_raster=self.loaded_bands[Sentinel2L2ABands.Red],
+                resample_to_ref=True,
             )
+        if "packed_cloud_mask" in names:
+            if "cloud_mask" in self._results:
+                packed = PackedMask.from_raster(self._results["cloud_mask"])
+            else:
+                packed = self.compute_packed_cloud_mask(
+                    scl_raster=self.loaded_bands[Sentinel2L2ABands.SCL],
+                    ref_raster=self.loaded_bands[Sentinel2L2ABands.Red],
+                    resample_to_ref=True,
+                )
+            self._results["packed_cloud_mask"] = packed
+
+    def is_computed(self, name: str) -> bool:
+        return name in self._results
+
+    def release(self, *names: str, drop_bands: bool = False) -> None:
+        # forget memoized results (all of them if no names are given). drop_bands also
+        # releases the loaded bands, which are then fetched again when needed.
+        for name in names or list(self._results):
+            self._results.pop(name, None)
+        if drop_bands:
+            self.loaded_bands.clear()
 
     @staticmethod
     def compute_cloud_mask(scl_raster: Raster, ref_raster:Raster = None, resample_to_ref: bool = False) -> Raster:
         mask_dtype = "uint8"
-        cloud_mask = np.isin(scl_raster.img, [0, 3, 8, 9,10]).astype(mask_dtype)
+        cloud_mask = np.isin(scl_raster.img, CLOUD_SCL_CLASSES).astype(mask_dtype)
         meta = scl_raster.meta.copy()
         meta["dtype"] = mask_dtype
         meta["nodata"] = None
@@ -71,10 +179,20 @@ class Sentinel2SpectralIndices(BaseSpectralIndices):
             target_affine_transform=ref_raster.meta["transform"],
             band_names=None,
         )
-        #rebinarize
-        cloud_upsampled.binarize()
+        #rebinarize, in place: the upsampled array is ours and bilinear keeps it >= 0
+        np.minimum(cloud_upsampled.img, 1, out=cloud_upsampled.img)
         return cloud_upsampled
 
+    @staticmethod
+    def compute_packed_cloud_mask(scl_raster: Raster, ref_raster: Raster = None, resample_to_ref: bool = False) -> PackedMask:
+        # same mask as compute_cloud_mask, one bit per pixel
+        if not resample_to_ref:
+            cloud_mask = np.isin(scl_raster.img, CLOUD_SCL_CLASSES)
+            return PackedMask.from_array(cloud_mask, meta=scl_raster.meta)
+        return PackedMask.from_raster(
+            Sentinel2SpectralIndices.compute_cloud_mask(scl_raster, ref_raster, resample_to_ref=True)
+        )
+
 
     @staticmethod
     def compute_ndvi(nir_raster: Raster, red_raster: Raster) -> Raster:
@@ -99,14 +217,15 @@ class Sentinel2SpectralIndices(BaseSpectralIndices):
     def compute_rgb_image(
         red_raster: Raster, green_raster: Raster, blue_raster: Raster
     ) -> Raster:
-        # Combine the Red, Green, and Blue into an RGB image
+        # Combine the Red, Green, and Blue into an RGB image, bands first.
+        # use .display_img for an h x w x 3 view.
         red = red_raster.img
         green = green_raster.img
         blue = blue_raster.img
-        rgb_image = np.stack([red, green, blue], axis=-1)
+        rgb_image = np.stack([red, green, blue], axis=0)
         meta = red_raster.meta.copy()
         meta["count"] = 3
-        return Raster(img=rgb_image, meta=meta, band_names=["Red", "Green", "Blue"])
+        return Raster(img=rgb_image, meta=meta, band_names=["Red", "Green", "Blue"], band_first=True)
 
     @staticmethod
     def compute_bsi(
@@ -0,0 +1,217 @@
+import math
+from contextlib import ExitStack
+from typing import Dict, Iterable, Iterator, List, Tuple, Type
+
+import numpy as np
+import pystac
+import rasterio
+from rasterio.windows import Window
+from rasterio.windows import bounds as window_bounds
+from rasterio.windows import from_bounds
+
+from src.sentinel2_handling.base_classes.aoi import AOI
+from src.sentinel2_handling.base_classes.fused_indices import (
+    INDEX_BAND_NAMES,
+    INDEX_INPUTS,
+    FusedIndexEngine,
+    required_bands,
+)
+from src.sentinel2_handling.base_classes.raster import Raster
+from src.sentinel2_handling.base_classes.sentinel2_bands import Sentinel2L2ABands
+from src.sentinel2_handling.base_classes.spectral_indices import (
+    Sentinel2SpectralIndices,
+)
+from src.sentinel2_handling.stac_item_sentinel2_processor import (
+    mask_outside_shapes,
+    open_href,
+)
+
+CLOUD_MASK_NAME = "cloud_mask"
+
+
+class BlockStreamingProcessor:
+    """
+    Computes spectral indices and the cloud mask of an item block by block, for AOIs
+    that do not fit in memory. Each block is read, resampled and processed with the
+    same code as the in-memory path, so peak memory depends on block_size only.
+    """
+
+    # extra 20m pixels read around each block so bilinear upsampling sees the same
+    # neighbours as it does on the whole AOI
+    HALO_PX = 2
+
+    _item: pystac.item.Item
+    _bbox: List
+
+    def __init__(
+        self,
+        item,
+        bbox,
+        indices: Iterable[str] = tuple(INDEX_INPUTS),
+        include_cloud_mask: bool = True,
+        block_size: int = 1024,
+        dtype: Type[np.floating] = np.float32,
+    ):
+        if len(bbox) != 4:
+            raise ValueError("Nope. the bbox should be a 4 tuple.")
+        if block_size % 16 != 0:
+            raise ValueError("block_size should be a multiple of 16 (GeoTIFF tiles).")
+
+        self._item = item
+        self._bbox = bbox
+        self._aoi = AOI.from_bbox(bbox)
+        self.indices = list(indices)
+        self.include_cloud_mask = include_cloud_mask
+        self.block_size = block_size
+        self.dtype = np.dtype(dtype)
+
+        self._bands = required_bands(self.indices)
+        if include_cloud_mask:
+            self._bands += [
+                b
+                for b in [Sentinel2L2ABands.SCL, Sentinel2L2ABands.Red]
+                if b not in self._bands
+            ]
+        # the output is on this band's 10m grid
+        self._ref_band = (
+            Sentinel2L2ABands.NIR if self.indices else Sentinel2L2ABands.Red
+        )
+
+    @property
+    def layer_names(self) -> List[str]:
+        return self.indices + ([CLOUD_MASK_NAME] if self.include_cloud_mask else [])
+
+    def _open_datasets(self, stack: ExitStack) -> Dict[Sentinel2L2ABands, object]:
+        return {
+            band: stack.enter_context(open_href(self._item.assets[band.value].href))
+            for band in self._bands
+        }
+
+    def _aoi_windows(self, datasets, crs) -> Dict[Sentinel2L2ABands, Window]:
+        windows = {}
+        for band, src in datasets.items():
+            windows[band] = self._aoi.window(
+                crs, src.transform, width=src.width, height=src.height
+            )
+        return windows
+
+    def _read_block(self, src, aoi_window, block_bounds, same_grid, shapes) -> Raster:
+        if same_grid:
+            window = from_bounds(*block_bounds, transform=src.transform).round_offsets()
+            window = Window(
+                window.col_off,
+                window.row_off,
+                round(window.width),
+                round(window.height),
+            )
+        else:
+            window = from_bounds(*block_bounds, transform=src.transform)
+            col_start = math.floor(window.col_off) - self.HALO_PX
+            row_start = math.floor(window.row_off) - self.HALO_PX
+            col_stop = math.ceil(window.col_off + window.width) + self.HALO_PX
+            row_stop = math.ceil(window.row_off + window.height) + self.HALO_PX
+            # never beyond the AOI window, which is all the in-memory path reads
+            window = Window(
+                col_start, row_start, col_stop - col_start, row_stop - row_start
+            ).intersection(aoi_window)
+
+        img = src.read(1, window=window)
+        transform = src.window_transform(window)
+        mask_outside_shapes(img, shapes, transform, src.nodata)
+
+        meta = src.meta.copy()
+        meta.update(
+            {"height": img.shape[0], "width": img.shape[1], "transform": transform}
+        )
+        return Raster(img=img, meta=meta, band_names=[src.name])
+
+    def _process_block(self, block_bands: Dict[Sentinel2L2ABands, Raster]):
+        layers = {}
+        if self.indices:
+            index_rasters = FusedIndexEngine(
+                indices=self.indices, dtype=self.dtype
+            ).compute(block_bands)
+            layers.update({name: r.img for name, r in index_rasters.items()})
+        if self.include_cloud_mask:
+            layers[CLOUD_MASK_NAME] = Sentinel2SpectralIndices.compute_cloud_mask(
+                scl_raster=block_bands[Sentinel2L2ABands.SCL],
+                ref_raster=block_bands[Sentinel2L2ABands.Red],
+                resample_to_ref=True,
+            ).img
+        return layers
+
+    def _prepare(self, datasets):
+        # AOI geometry in the tile CRS and the AOI window of every band
+        ref_src = datasets[self._ref_band]
+        shapes = self._aoi.shapes(ref_src.crs)
+        return shapes, self._aoi_windows(datasets, ref_src.crs)
+
+    def _stream(
+        self, datasets, shapes, aoi_windows
+    ) -> Iterator[Tuple[Window, Dict[str, np.ndarray]]]:
+        ref_src = datasets[self._ref_band]
+        ref_window = aoi_windows[self._ref_band]
+
+        for row_off in range(0, int(ref_window.height), self.block_size):
+            for col_off in range(0, int(ref_window.width), self.block_size):
+                block = Window(
+                    col_off,
+                    row_off,
+                    min(self.block_size, ref_window.width - col_off),
+                    min(self.block_size, ref_window.height - row_off),
+                )
+                abs_block = Window(
+                    ref_window.col_off + col_off,
+                    ref_window.row_off + row_off,
+                    block.width,
+                    block.height,
+                )
+                block_bounds = window_bounds(abs_block, ref_src.transform)
+                block_bands = {
+                    band: self._read_block(
+                        src,
+                        aoi_windows[band],
+                        block_bounds,
+                        same_grid=src.transform == ref_src.transform,
+                        shapes=shapes,
+                    )
+                    for band, src in datasets.items()
+                }
+                yield block, self._process_block(block_bands)
+
+    def iter_blocks(self) -> Iterator[Tuple[Window, Dict[str, np.ndarray]]]:
+        # yields (window within the AOI grid, {layer name: array}) per block
+        with ExitStack() as stack:
+            datasets = self._open_datasets(stack)
+            yield from self._stream(datasets, *self._prepare(datasets))
+
+    def write_to_file(self, filename, compress="deflate") -> None:
+        with ExitStack() as stack:
+            datasets = self._open_datasets(stack)
+            shapes, aoi_windows = self._prepare(datasets)
+            ref_src = datasets[self._ref_band]
+            ref_window = aoi_windows[self._ref_band]
+
+            profile = {
+                "driver": "GTiff",
+                "height": int(ref_window.height),
+                "width": int(ref_window.width),
+                "count": len(self.layer_names),
+                "dtype": self.dtype.name,
+                "crs": ref_src.crs,
+                "transform": ref_src.window_transform(ref_window),
+                "nodata": None,
+                "tiled": True,
+                "blockxsize": self.block_size,
+                "blockysize": self.block_size,
+                "compress": compress,
+                "BIGTIFF": "IF_SAFER",
+            }
+            with rasterio.open(filename, "w", **profile) as dst:
+                for b, name in enumerate(self.layer_names):
+                    dst.set_band_description(
+                        b + 1, INDEX_BAND_NAMES.get(name, "CloudMask (SCL)")
+                    )
+                for window, layers in self._stream(datasets, shapes, aoi_windows):
+                    for b, name in enumerate(self.layer_names):
+                        dst.write(layers[name].astype(self.dtype), b + 1, window=window)
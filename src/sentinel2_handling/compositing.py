@@ -0,0 +1,176 @@
+import warnings
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from rasterio.windows import Window
+
+from src.sentinel2_handling.base_classes.packed_mask import PackedMask
+from src.sentinel2_handling.base_classes.raster import Raster
+from src.sentinel2_handling.datacube import CLOUD_MASK_LAYER, Datacube
+
+COMPOSITE_METHODS = ("best", "median", "max_ndvi")
+CLEAR_COUNT_NAME = "clear_count"
+
+
+def composite_stack(
+    stack: np.ndarray,
+    cloudy: np.ndarray,
+    method: str = "best",
+    ndvi: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Per-pixel composite of a T x B x H x W stack. cloudy is T x H x W, True where
+    an observation must not be used (cloud, shadow, no data). Pixels without any
+    clear observation are NaN.
+
+    best: first clear observation along T, so order the stack by preference.
+    median: median of the clear observations of each band.
+    max_ndvi: all bands from the clear observation with the highest NDVI (T x H x W).
+    """
+    clear = ~cloudy & ~np.isnan(stack).any(axis=1)
+    any_clear = clear.any(axis=0)
+
+    if method == "median":
+        masked = np.where(clear[:, None], stack, np.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN pixels
+            return np.nanmedian(masked, axis=0).astype(stack.dtype, copy=False)
+
+    if method == "best":
+        pick = np.argmax(clear, axis=0)
+    elif method == "max_ndvi":
+        if ndvi is None:
+            raise ValueError("max_ndvi compositing needs the NDVI stack.")
+        pick = np.argmax(np.where(clear, ndvi, -np.inf), axis=0)
+    else:
+        raise ValueError(
+            f"Unknown compositing method {method}, use {COMPOSITE_METHODS}"
+        )
+
+    out = np.take_along_axis(stack, pick[None, None], axis=0)[0]
+    out[:, ~any_clear] = np.nan
+    return out
+
+
+class CompositingEngine:
+    """
+    Builds composites from a Datacube's cloud_mask layer. The cube is read in row
+    chunks so only T x B x chunk_rows x W values are in memory at a time.
+    """
+
+    CHUNK_BYTES = 64 * 1024 * 1024
+
+    def __init__(
+        self,
+        cube: Datacube,
+        method: str = "best",
+        layers: Optional[Sequence[str]] = None,
+        chunk_rows: Optional[int] = None,
+    ):
+        if CLOUD_MASK_LAYER not in cube.layers:
+            raise ValueError("The datacube needs a cloud_mask layer to composite.")
+        if method == "max_ndvi" and "ndvi" not in cube.layers:
+            raise ValueError("max_ndvi compositing needs an ndvi layer in the cube.")
+        if method not in COMPOSITE_METHODS:
+            raise ValueError(
+                f"Unknown compositing method {method}, use {COMPOSITE_METHODS}"
+            )
+
+        self.cube = cube
+        self.method = method
+        self.layers = [
+            name
+            for name in (cube.layers if layers is None else layers)
+            if name != CLOUD_MASK_LAYER
+        ]
+        self.chunk_rows = chunk_rows
+
+    def _chunk_rows(self, n_dates: int) -> int:
+        if self.chunk_rows is not None:
+            return self.chunk_rows
+        row_bytes = n_dates * (len(self.layers) + 2) * self.cube.shape[1] * 4
+        return max(1, self.CHUNK_BYTES // max(row_bytes, 1))
+
+    def _ordered_entries(self, start_date, end_date) -> List[Dict]:
+        entries = self.cube.entries_between(start_date, end_date)
+        if self.method == "best":
+            # most usable scenes first, later scenes only fill their gaps
+            entries = sorted(entries, key=lambda e: -e["usable_pixels"])
+        return entries
+
+    def composite(self, start_date=None, end_date=None) -> Raster:
+        """
+        Composite of the dates between start_date and end_date (inclusive,
+        YYYY-MM-DD). The last band is the number of clear observations per pixel.
+        """
+        entries = self._ordered_entries(start_date, end_date)
+        if not entries:
+            raise ValueError(
+                f"No dates in the datacube between {start_date} and {end_date}."
+            )
+
+        height, width = self.cube.shape
+        out = np.full(
+            (len(self.layers) + 1, height, width), np.nan, dtype=self.cube.dtype
+        )
+        read_layers = list(self.layers) + [CLOUD_MASK_LAYER]
+        if self.method == "max_ndvi" and "ndvi" not in self.layers:
+            read_layers.append("ndvi")
+
+        rows = self._chunk_rows(len(entries))
+        for row in range(0, height, rows):
+            window = Window(0, row, width, min(rows, height - row))
+            stack = np.stack(
+                [self.cube.read_entry(entry, read_layers, window) for entry in entries]
+            )
+            cloudy = stack[:, len(self.layers)] != 0
+            ndvi = (
+                stack[:, read_layers.index("ndvi")]
+                if self.method == "max_ndvi"
+                else None
+            )
+            values = stack[:, : len(self.layers)]
+
+            chunk = slice(row, row + window.height)
+            out[:-1, chunk] = composite_stack(values, cloudy, self.method, ndvi)
+            out[-1, chunk] = (~cloudy & ~np.isnan(values).any(axis=1)).sum(axis=0)
+
+        meta = {
+            "driver": "GTiff",
+            "dtype": self.cube.dtype.name,
+            "nodata": np.nan,
+            "width": width,
+            "height": height,
+            "count": len(self.layers) + 1,
+            "crs": self.cube.crs,
+            "transform": self.cube.transform,
+        }
+        return Raster(
+            img=out,
+            meta=meta,
+            band_names=list(self.layers) + [CLEAR_COUNT_NAME],
+            band_first=True,
+        )
+
+    def clear_coverage_pct(self, start_date=None, end_date=None) -> float:
+        """
+        Percentage of the grid with at least one clear observation between the
+        dates, from the packed masks alone (no band data is read).
+        """
+        entries = self.cube.entries_between(start_date, end_date)
+        if not entries:
+            raise ValueError(
+                f"No dates in the datacube between {start_date} and {end_date}."
+            )
+        always_cloudy = PackedMask.all_of(
+            self.cube.cloud_mask(entry) for entry in entries
+        )
+        return always_cloudy.clear_pct()
+
+    def monthly(self) -> "OrderedDict[str, Raster]":
+        """One composite per calendar month (YYYY-MM) present in the cube."""
+        months = sorted({date[:7] for date in self.cube.dates})
+        return OrderedDict(
+            (month, self.composite(f"{month}-01", f"{month}-31")) for month in months
+        )
@@ -0,0 +1,334 @@
+import json
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import rasterio.warp
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+from src.sentinel2_handling.base_classes.fused_indices import INDEX_INPUTS
+from src.sentinel2_handling.base_classes.packed_mask import PackedMask
+from src.sentinel2_handling.base_classes.raster import Raster
+from src.sentinel2_handling.base_classes.sentinel2_bands import Sentinel2L2ABands
+from src.sentinel2_handling.stac_item_sentinel2_processor import (
+    StacItemSentinel2Processor,
+)
+
+CLOUD_MASK_LAYER = "cloud_mask"
+BAND_LAYERS = [band.value for band in Sentinel2L2ABands]
+DEFAULT_LAYERS = ["B02", "B03", "B04", "B08", "ndvi", "bsi", "ndmi", "savi"] + [
+    CLOUD_MASK_LAYER
+]
+
+
+class Datacube:
+    """
+    T x B x H x W stack of bands, indices and cloud masks on one common grid.
+
+    On disk, each date is its own .npy shard (B x H x W) that is memory mapped on
+    read, so appending dates never rewrites existing data. The cloud mask of each
+    date is kept bit-packed next to it (see PackedMask). cube.json holds the grid
+    and layer names, index.json the dates and item metadata.
+    """
+
+    CUBE_FILE = "cube.json"
+    INDEX_FILE = "index.json"
+    SHARD_DIR = "shards"
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, self.CUBE_FILE)) as f:
+            cube = json.load(f)
+        self.layers: List[str] = cube["layers"]
+        self.dtype = np.dtype(cube["dtype"])
+        self.crs = CRS.from_wkt(cube["crs"])
+        self.transform = Affine(*cube["transform"])
+        self.shape: Tuple[int, int] = tuple(cube["shape"])
+
+        with open(os.path.join(path, self.INDEX_FILE)) as f:
+            self.entries: List[Dict] = json.load(f)
+
+    @classmethod
+    def create(
+        cls,
+        path,
+        crs,
+        transform: Affine,
+        shape: Tuple[int, int],
+        layers: Sequence[str] = DEFAULT_LAYERS,
+        dtype=np.float32,
+    ) -> "Datacube":
+        unknown = set(layers) - set(BAND_LAYERS) - set(INDEX_INPUTS)
+        unknown -= {CLOUD_MASK_LAYER}
+        if unknown:
+            raise ValueError(f"Unknown layers: {sorted(unknown)}")
+        if os.path.exists(os.path.join(path, cls.CUBE_FILE)):
+            raise ValueError(f"There is already a datacube in {path}.")
+
+        os.makedirs(os.path.join(path, cls.SHARD_DIR), exist_ok=True)
+        cube = {
+            "layers": list(layers),
+            "dtype": np.dtype(dtype).name,
+            "crs": CRS.from_user_input(crs).to_wkt(),
+            "transform": list(transform)[:6],
+            "shape": list(shape),
+        }
+        with open(os.path.join(path, cls.CUBE_FILE), "w") as f:
+            json.dump(cube, f)
+        with open(os.path.join(path, cls.INDEX_FILE), "w") as f:
+            json.dump([], f)
+        return cls(path)
+
+    @classmethod
+    def from_processors(
+        cls,
+        path,
+        processors: List[StacItemSentinel2Processor],
+        metadata: List[Tuple],
+        layers: Sequence[str] = DEFAULT_LAYERS,
+        dtype=np.float32,
+    ) -> "Datacube":
+        """
+        Builds a cube from filter_item_list results. The grid is the 10m grid of the
+        first item. Items in another CRS or window are reprojected onto it.
+        """
+        if not processors:
+            raise ValueError("Need at least one processor to set the grid.")
+        ref = processors[0]._load_bands([Sentinel2L2ABands.Red])[Sentinel2L2ABands.Red]
+        cube = cls.create(
+            path,
+            crs=ref.meta["crs"],
+            transform=ref.meta["transform"],
+            shape=ref.spatial_shape,
+            layers=layers,
+            dtype=dtype,
+        )
+        cube.append(processors, metadata)
+        return cube
+
+    @property
+    def dates(self) -> List[str]:
+        return [entry["date"] for entry in self.entries]
+
+    @property
+    def item_ids(self) -> List[str]:
+        return [entry["item_id"] for entry in self.entries]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @property
+    def data_layers(self) -> List[str]:
+        # layers stored in the float shards
+        return [name for name in self.layers if name != CLOUD_MASK_LAYER]
+
+    def _shard_path(self, entry: Dict) -> str:
+        return os.path.join(self.path, self.SHARD_DIR, entry["shard"])
+
+    def _to_grid(self, raster: Raster, resampling: Resampling) -> np.ndarray:
+        if (
+            raster.spatial_shape == self.shape
+            and raster.meta["transform"] == self.transform
+            and CRS.from_user_input(raster.meta["crs"]) == self.crs
+        ):
+            return raster.img.astype(self.dtype, copy=False)
+
+        out = np.zeros(self.shape, dtype=self.dtype)
+        rasterio.warp.reproject(
+            raster.img.astype(self.dtype, copy=False),
+            out,
+            src_transform=raster.meta["transform"],
+            src_crs=raster.meta["crs"],
+            dst_transform=self.transform,
+            dst_crs=self.crs,
+            resampling=resampling,
+        )
+        return out
+
+    def _layer_rasters(self, proc: StacItemSentinel2Processor) -> Dict[str, Raster]:
+        attributes = [name for name in self.layers if name in INDEX_INPUTS]
+        if CLOUD_MASK_LAYER in self.layers:
+            attributes.append(CLOUD_MASK_LAYER)
+        bands = [Sentinel2L2ABands(name) for name in self.layers if name in BAND_LAYERS]
+
+        spectral_indices = proc.load_and_compute_spectral_indices(indices=attributes)
+        rasters = {name: getattr(spectral_indices, name) for name in attributes}
+        for band, raster in proc._load_bands(bands).items():
+            rasters[band.value] = raster
+        return rasters
+
+    def append(
+        self,
+        processors: List[StacItemSentinel2Processor],
+        metadata: List[Tuple],
+        release: bool = True,
+    ) -> None:
+        """
+        Adds new dates. metadata is filter_item_list's (date, eo:cloud_cover, usable %)
+        per processor. Items already in the cube are skipped. release frees each
+        item's bands and indices once its shard is written.
+        """
+        known_items = set(self.item_ids)
+        for proc, item_metadata in zip(processors, metadata):
+            item_id = proc._item.id
+            if item_id in known_items:
+                continue
+
+            rasters = self._layer_rasters(proc)
+            shard_name = f"{item_id}.npy"
+            shard = np.lib.format.open_memmap(
+                os.path.join(self.path, self.SHARD_DIR, shard_name),
+                mode="w+",
+                dtype=self.dtype,
+                shape=(len(self.data_layers),) + self.shape,
+            )
+            for b, name in enumerate(self.data_layers):
+                resampling = (
+                    Resampling.nearest
+                    if name == Sentinel2L2ABands.SCL.value
+                    else Resampling.bilinear
+                )
+                shard[b] = self._to_grid(rasters[name], resampling)
+            shard.flush()
+            del shard
+
+            date, cloud_cover, usable_pct = item_metadata
+            entry = {
+                "date": date,
+                "item_id": item_id,
+                "eo:cloud_cover": float(cloud_cover),
+                "usable_pixels": float(usable_pct),
+                "shard": shard_name,
+            }
+            if CLOUD_MASK_LAYER in self.layers:
+                entry["mask"] = f"{item_id}.mask.npy"
+                cloud_mask = self._to_grid(
+                    rasters[CLOUD_MASK_LAYER], Resampling.nearest
+                )
+                np.save(
+                    os.path.join(self.path, self.SHARD_DIR, entry["mask"]),
+                    PackedMask.from_array(cloud_mask).packed,
+                )
+            self.entries.append(entry)
+            known_items.add(item_id)
+            if release and proc.spectral_indices is not None:
+                proc.spectral_indices.release(drop_bands=True)
+
+        self.entries.sort(key=lambda entry: (entry["date"], entry["item_id"]))
+        self._write_index()
+
+    def _write_index(self) -> None:
+        index_path = os.path.join(self.path, self.INDEX_FILE)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(index_path + ".tmp", index_path)
+
+    def _select(self, start_date=None, end_date=None) -> List[int]:
+        # dates are compared as YYYY-MM-DD strings, end inclusive
+        return [
+            t
+            for t, date in enumerate(self.dates)
+            if (start_date is None or date >= start_date)
+            and (end_date is None or date <= end_date)
+        ]
+
+    def read(
+        self,
+        layers: Optional[Sequence[str]] = None,
+        start_date: Optional[str] = None,
+        end_date: Optional[str] = None,
+        window: Optional[Window] = None,
+    ) -> np.ndarray:
+        """
+        Returns a T x B x H x W array for the selected layers, date range and window.
+        Only the selected part of each shard is read from disk.
+        """
+        layers = self.layers if layers is None else list(layers)
+        if window is None:
+            rows, cols = slice(0, self.shape[0]), slice(0, self.shape[1])
+        else:
+            rows, cols = window.toslices()
+
+        times = self._select(start_date, end_date)
+        height = len(range(*rows.indices(self.shape[0])))
+        width = len(range(*cols.indices(self.shape[1])))
+        out = np.empty((len(times), len(layers), height, width), dtype=self.dtype)
+        for i, t in enumerate(times):
+            out[i] = self.read_entry(self.entries[t], layers, window)
+        return out
+
+    def read_entry(
+        self, entry: Dict, layers: Sequence[str], window: Optional[Window] = None
+    ) -> np.ndarray:
+        """B x H x W array of the given layers for one index entry."""
+        shard = np.load(self._shard_path(entry), mmap_mode="r")
+        rows, cols = (slice(None), slice(None)) if window is None else window.toslices()
+        data_layers = self.data_layers
+        out = None
+        for b, name in enumerate(layers):
+            if name == CLOUD_MASK_LAYER:
+                layer = self.cloud_mask(entry).unpack(window)
+            else:
+                layer = shard[data_layers.index(name), rows, cols]
+            if out is None:
+                out = np.empty((len(layers),) + layer.shape, dtype=self.dtype)
+            out[b] = layer
+        return out
+
+    def cloud_mask(self, entry: Dict) -> PackedMask:
+        """The entry's cloud mask, bit-packed and memory mapped."""
+        if "mask" not in entry:
+            raise ValueError("This datacube has no cloud_mask layer.")
+        packed = np.load(
+            os.path.join(self.path, self.SHARD_DIR, entry["mask"]), mmap_mode="r"
+        )
+        meta = {"crs": self.crs, "transform": self.transform}
+        return PackedMask(packed, self.shape, meta=meta)
+
+    def _find_entry(self, date: Optional[str], item_id: Optional[str]) -> Dict:
+        if (date is None) == (item_id is None):
+            raise ValueError("Give either a date or an item_id.")
+        if item_id is not None:
+            matches = [entry for entry in self.entries if entry["item_id"] == item_id]
+        else:
+            matches = [entry for entry in self.entries if entry["date"] == date]
+        if not matches:
+            raise ValueError(f"No entry for {item_id or date}.")
+        if len(matches) > 1:
+            # e.g. two tiles of the same overpass
+            ids = ", ".join(entry["item_id"] for entry in matches)
+            raise ValueError(
+                f"{len(matches)} items on {date} ({ids}), give an item_id."
+            )
+        return matches[0]
+
+    def entries_between(self, start_date=None, end_date=None) -> List[Dict]:
+        return [self.entries[t] for t in self._select(start_date, end_date)]
+
+    def layer_raster(
+        self, layer: str, date: Optional[str] = None, item_id: Optional[str] = None
+    ) -> Raster:
+        """
+        One layer of one entry as a Raster, e.g. to write it out with to_file. The
+        entry is picked by item_id, or by date when only one item has that date.
+        """
+        entry = self._find_entry(date, item_id)
+        meta = {
+            "driver": "GTiff",
+            "dtype": self.dtype.name,
+            "nodata": None,
+            "width": self.shape[1],
+            "height": self.shape[0],
+            "count": 1,
+            "crs": self.crs,
+            "transform": self.transform,
+        }
+        if layer == CLOUD_MASK_LAYER:
+            img = self.cloud_mask(entry).unpack().astype(self.dtype)
+        else:
+            shard = np.load(self._shard_path(entry), mmap_mode="r")
+            img = shard[self.data_layers.index(layer)]
+        return Raster(img=img, meta=meta, band_names=[layer])
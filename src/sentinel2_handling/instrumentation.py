@@ -0,0 +1,194 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Sequence
+
+# per-stage records of the pipeline (STAC search, href signing, dataset open, reads,
+# resampling, index maths). Off by default: stage() is then a shared no-op.
+_enabled = False
+_enabled_pid: Optional[int] = None
+_records: List[Dict] = []
+_lock = threading.Lock()
+
+# item and band that stages inside a scope() are attributed to
+_scope: contextvars.ContextVar = contextvars.ContextVar("instrumentation_scope")
+
+
+def enable() -> None:
+    """
+    Starts recording stages in this process:
+
+        instrumentation.enable()
+        metadata, processors = filter_item_list(items, bbox)
+        print(instrumentation.summary())
+        instrumentation.export_jsonl("run.jsonl")
+
+    Each record holds stage, seconds, item, band, pid and what the stage adds:
+    bytes_read (decoded pixel bytes read from a dataset) and array_bytes (bytes of
+    the arrays it allocated for its results).
+    """
+    global _enabled, _enabled_pid
+    _enabled = True
+    _enabled_pid = os.getpid()
+
+
+def disable() -> None:
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, **fields) -> None:
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, name: str, fields: Dict):
+        scope = _scope.get({})
+        self.record = {
+            "stage": name,
+            "item": scope.get("item"),
+            "band": scope.get("band"),
+            **fields,
+        }
+
+    def add(self, **fields) -> None:
+        # sums numeric fields, so a stage can report bytes as it goes
+        for key, value in fields.items():
+            if isinstance(value, (int, float)) and key in self.record:
+                self.record[key] += value
+            else:
+                self.record[key] = value
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.record["seconds"] = time.perf_counter() - self._start
+        self.record["pid"] = os.getpid()
+        if exc_type is not None:
+            self.record["error"] = exc_type.__name__
+        with _lock:
+            _records.append(self.record)
+        return False
+
+
+def stage(name: str, **fields):
+    """
+    Context manager timing one stage. Its add() attaches fields to the record, e.g.
+    with stage("read") as s: ...; s.add(bytes_read=img.nbytes)
+    """
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name, fields)
+
+
+class _Scope:
+    def __init__(self, fields: Dict):
+        self.fields = fields
+
+    def __enter__(self):
+        merged = {**_scope.get({}), **self.fields}
+        self._token = _scope.set(merged)
+        return self
+
+    def __exit__(self, *exc):
+        _scope.reset(self._token)
+        return False
+
+
+def scope(item: Optional[str] = None, band: Optional[str] = None):
+    """Attributes the stages run inside it (in this thread) to item and band."""
+    if not _enabled:
+        return _NULL_STAGE
+    fields = {k: v for k, v in (("item", item), ("band", band)) if v is not None}
+    return _Scope(fields)
+
+
+def records() -> List[Dict]:
+    with _lock:
+        return list(_records)
+
+
+def reset() -> None:
+    with _lock:
+        _records.clear()
+
+
+def add_records(new_records: Iterable[Dict]) -> None:
+    # e.g. records sent back by worker processes
+    with _lock:
+        _records.extend(new_records)
+
+
+def call_with_records(fn, *args, **kwargs):
+    """
+    Runs fn(*args, **kwargs) with instrumentation enabled and returns (result,
+    records of the call), for joblib tasks whose records should reach the parent
+    through add_records. In the process that called enable() the records are
+    already stored there, so none are returned.
+    """
+    if _enabled and _enabled_pid == os.getpid():
+        return fn(*args, **kwargs), []
+    was_enabled = _enabled
+    enable()
+    try:
+        result = fn(*args, **kwargs)
+    finally:
+        # worker processes are reused, so leave them as they were
+        if not was_enabled:
+            disable()
+        with _lock:
+            collected = list(_records)
+            _records.clear()
+    return result, collected
+
+
+def export_jsonl(path, recs: Optional[List[Dict]] = None) -> None:
+    with open(path, "w") as f:
+        for record in records() if recs is None else recs:
+            f.write(json.dumps(record, default=str) + "\n")
+
+
+def summary(recs: Optional[List[Dict]] = None, by: Sequence[str] = ("stage",)) -> str:
+    """
+    Table of calls, total and mean time, MB read and MB allocated, grouped by the
+    record fields in by, e.g. ("item", "stage") or ("band", "stage").
+    """
+    groups = defaultdict(list)
+    for record in records() if recs is None else recs:
+        groups[tuple(str(record.get(key)) for key in by)].append(record)
+
+    header = " ".join(f"{key:24s}" for key in by)
+    lines = [
+        f"{header} {'calls':>6s} {'total s':>9s} {'mean ms':>9s}"
+        f" {'read MB':>9s} {'alloc MB':>9s}"
+    ]
+    rows = sorted(groups.items(), key=lambda kv: -sum(r["seconds"] for r in kv[1]))
+    for key, group in rows:
+        total = sum(r["seconds"] for r in group)
+        read_mb = sum(r.get("bytes_read", 0) for r in group) / 2**20
+        alloc_mb = sum(r.get("array_bytes", 0) for r in group) / 2**20
+        label = " ".join(f"{k[:24]:24s}" for k in key)
+        lines.append(
+            f"{label} {len(group):6d} {total:9.3f} {total / len(group) * 1000:9.2f}"
+            f" {read_mb:9.1f} {alloc_mb:9.1f}"
+        )
+    return "\n".join(lines)
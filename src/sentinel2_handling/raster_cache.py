@@ -0,0 +1,147 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from src.sentinel2_handling.base_classes.raster import (
+    Raster,
+    meta_from_json,
+    meta_to_json,
+)
+
+
+class RasterDiskCache:
+    """
+    Local cache of clipped band rasters, stored as compressed npz files.
+    The disk budget is enforced with least-recently-used eviction, where a file's
+    mtime is its last use. Safe to share between threads and processes.
+    """
+
+    FILE_SUFFIX = ".npz"
+
+    def __init__(self, cache_dir: str, max_bytes: int = 2 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __getstate__(self):
+        # locks cannot be pickled (e.g. when sent to joblib workers)
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(
+        item_id: str, asset_key: str, bbox: List, crs=None, read_mode: str = ""
+    ) -> str:
+        key_parts = [
+            item_id,
+            asset_key,
+            [round(float(c), 9) for c in bbox],
+            None if crs is None else str(crs),
+            read_mode,
+        ]
+        return hashlib.sha1(json.dumps(key_parts).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + self.FILE_SUFFIX)
+
+    def __contains__(self, key: str) -> bool:
+        # not counted as a lookup; get() may still miss if the entry is evicted
+        return os.path.exists(self._path(key))
+
+    def get(self, key: str) -> Optional[Raster]:
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                img = data["img"]
+                meta = meta_from_json(str(data["meta"]))
+                band_names = [str(b) for b in data["band_names"]]
+        except (OSError, ValueError, KeyError):
+            # missing, evicted by another process or partially written
+            with self._lock:
+                self.misses += 1
+            return None
+
+        try:
+            # mark as recently used
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return Raster(img=img, meta=meta, band_names=band_names)
+
+    def put(self, key: str, raster: Raster) -> None:
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(
+                f,
+                img=raster.img,
+                meta=np.array(meta_to_json(raster.meta)),
+                band_names=np.array(raster.band_names),
+            )
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, "*" + self.FILE_SUFFIX)):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        # oldest first
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+    def clear(self) -> None:
+        for path in glob.glob(os.path.join(self.cache_dir, "*" + self.FILE_SUFFIX)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def add_lookups(self, hits: int, misses: int) -> None:
+        # e.g. lookups made by a worker process on its own copy of the cache
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def stats(self) -> Dict:
+        """
+        Entries and bytes are read from disk. Hits and misses count the lookups made
+        through this object; filter_item_list adds those of its worker processes.
+        """
+        sizes = [
+            os.path.getsize(path)
+            for path in glob.glob(os.path.join(self.cache_dir, "*" + self.FILE_SUFFIX))
+        ]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(sizes),
+            "bytes": sum(sizes),
+            "max_bytes": self.max_bytes,
+        }
@@ -0,0 +1,277 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+from rasterio.abc import MultiByteRangeResourceContainer
+
+if TYPE_CHECKING:
+    import requests
+
+
+def _cache_key(href: str) -> str:
+    # signed hrefs change their query string, the file behind them does not
+    return urlsplit(href)._replace(query="", fragment="").geturl()
+
+
+class HTTPRangeOpener(MultiByteRangeResourceContainer):
+    """
+    rasterio opener that reads COGs over HTTP range requests:
+
+        with rasterio.open(href, opener=opener) as src:
+
+    - one pooled requests.Session, so connections are reused across files and threads
+    - the first header_bytes of each file (the COG header and IFDs) are fetched in
+      one request and kept per href, so reopening a band costs no header round trips
+    - other small reads go through a shared block cache
+    - GDAL's multi-range tile reads are merged when the gap between them is at most
+      max_gap_bytes, and the merged requests run in parallel
+    - requests, bytes_fetched and header_hits count what went over the wire
+
+    Works against any server that honours Range headers.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 32,
+        header_bytes: int = 64 * 1024,
+        block_bytes: int = 64 * 1024,
+        max_cached_bytes: int = 64 * 1024**2,
+        max_gap_bytes: int = 64 * 1024,
+        timeout: float = 30.0,
+    ):
+        self.pool_size = pool_size
+        self.header_bytes = header_bytes
+        self.block_bytes = block_bytes
+        self.max_cached_bytes = max_cached_bytes
+        self.max_gap_bytes = max_gap_bytes
+        self.timeout = timeout
+
+        self.requests = 0
+        self.bytes_fetched = 0
+        self.header_hits = 0
+
+        # imported here so that importing this module stays cheap
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._range_pool = ThreadPoolExecutor(max_workers=pool_size)
+
+        self._lock = threading.Lock()
+        self._headers: Dict[str, Tuple[int, bytes]] = {}  # key -> (size, header)
+        self._missing = set()
+        self._blocks: "OrderedDict[Tuple[str, int], bytes]" = OrderedDict()
+        self._cached_bytes = 0
+
+    def settings(self) -> Dict:
+        # constructor arguments, e.g. to build the same opener in a worker process
+        return {
+            "pool_size": self.pool_size,
+            "header_bytes": self.header_bytes,
+            "block_bytes": self.block_bytes,
+            "max_cached_bytes": self.max_cached_bytes,
+            "max_gap_bytes": self.max_gap_bytes,
+            "timeout": self.timeout,
+        }
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "requests": self.requests,
+            "bytes_fetched": self.bytes_fetched,
+            "header_hits": self.header_hits,
+        }
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.requests = self.bytes_fetched = self.header_hits = 0
+
+    def clear(self) -> None:
+        with self._lock:
+            self._headers.clear()
+            self._missing.clear()
+            self._blocks.clear()
+            self._cached_bytes = 0
+
+    def _get(self, href: str, start: int, end: int) -> "requests.Response":
+        # end is inclusive, like the Range header
+        response = self._session.get(
+            href, headers={"Range": f"bytes={start}-{end}"}, timeout=self.timeout
+        )
+        with self._lock:
+            self.requests += 1
+            self.bytes_fetched += len(response.content)
+        return response
+
+    def fetch_range(self, href: str, start: int, end: int) -> bytes:
+        response = self._get(href, start, end)
+        response.raise_for_status()
+        return response.content
+
+    def _header(self, href: str) -> Optional[Tuple[int, bytes]]:
+        if urlsplit(href).scheme not in ("http", "https"):
+            return None
+        key = _cache_key(href)
+        with self._lock:
+            if key in self._headers:
+                self.header_hits += 1
+                return self._headers[key]
+            if key in self._missing:
+                return None
+
+        response = self._get(href, 0, self.header_bytes - 1)
+        if response.status_code == 404:
+            with self._lock:
+                self._missing.add(key)
+            return None
+        response.raise_for_status()
+        if response.status_code == 206:
+            size = int(response.headers["Content-Range"].rsplit("/", 1)[1])
+        else:
+            size = len(response.content)  # server ignored Range
+        header = (size, response.content[: self.header_bytes])
+        with self._lock:
+            self._headers[key] = header
+        return header
+
+    def _read_blocks(self, href: str, size: int, start: int, end: int) -> bytes:
+        # serves [start, end) from cached blocks, fetching missing ones in one request
+        key = _cache_key(href)
+        first, last = start // self.block_bytes, (end - 1) // self.block_bytes
+        with self._lock:
+            blocks = {i: self._blocks.get((key, i)) for i in range(first, last + 1)}
+            for i, block in blocks.items():
+                if block is not None:
+                    self._blocks.move_to_end((key, i))
+
+        missing = [i for i, block in blocks.items() if block is None]
+        if missing:
+            fetch_start = missing[0] * self.block_bytes
+            fetch_end = min((missing[-1] + 1) * self.block_bytes, size) - 1
+            data = self.fetch_range(href, fetch_start, fetch_end)
+            with self._lock:
+                for i in range(missing[0], missing[-1] + 1):
+                    offset = i * self.block_bytes - fetch_start
+                    block = data[offset : offset + self.block_bytes]
+                    blocks[i] = block
+                    if (key, i) not in self._blocks:
+                        self._blocks[(key, i)] = block
+                        self._cached_bytes += len(block)
+                while self._cached_bytes > self.max_cached_bytes and self._blocks:
+                    _, evicted = self._blocks.popitem(last=False)
+                    self._cached_bytes -= len(evicted)
+
+        data = b"".join(blocks[i] for i in range(first, last + 1))
+        offset = first * self.block_bytes
+        return data[start - offset : end - offset]
+
+    def read(self, href: str, start: int, length: int) -> bytes:
+        header = self._header(href)
+        if header is None:
+            raise FileNotFoundError(href)
+        size, header_data = header
+        end = min(start + length, size)
+        if start >= end:
+            return b""
+        if end <= len(header_data):
+            return header_data[start:end]
+        if end - start > 4 * self.block_bytes:
+            # tile data: too big to be worth caching
+            return self.fetch_range(href, start, end - 1)
+        return self._read_blocks(href, size, start, end)
+
+    def read_ranges(
+        self, href: str, offsets: Sequence[int], sizes: Sequence[int]
+    ) -> List[bytes]:
+        order = sorted(range(len(offsets)), key=lambda i: offsets[i])
+        merged: List[List] = []  # [start, end, [range indices]]
+        for i in order:
+            start, end = offsets[i], offsets[i] + sizes[i]
+            if merged and start - merged[-1][1] <= self.max_gap_bytes:
+                merged[-1][1] = max(merged[-1][1], end)
+                merged[-1][2].append(i)
+            else:
+                merged.append([start, end, [i]])
+
+        chunks = self._range_pool.map(
+            lambda m: self.read(href, m[0], m[1] - m[0]), merged
+        )
+        out: List[bytes] = [b""] * len(offsets)
+        for (start, _, indices), chunk in zip(merged, chunks):
+            for i in indices:
+                offset = offsets[i] - start
+                out[i] = chunk[offset : offset + sizes[i]]
+        return out
+
+    # MultiByteRangeResourceContainer interface, called by GDAL through rasterio
+    def open(self, path, mode="rb", **kwargs) -> "_RangeFile":
+        if "w" in mode or "+" in mode:
+            raise ValueError("HTTPRangeOpener is read only.")
+        if self._header(path) is None:
+            raise FileNotFoundError(path)
+        return _RangeFile(self, path)
+
+    def isfile(self, path) -> bool:
+        return self._header(path) is not None
+
+    def isdir(self, path) -> bool:
+        return False
+
+    def ls(self, path) -> List[str]:
+        return []
+
+    def mtime(self, path) -> int:
+        return 0
+
+    def size(self, path) -> int:
+        header = self._header(path)
+        if header is None:
+            raise FileNotFoundError(path)
+        return header[0]
+
+    def rm(self, path) -> None:
+        raise ValueError("HTTPRangeOpener is read only.")
+
+
+class _RangeFile:
+    # file-like view of one href, as handed to GDAL
+    def __init__(self, opener: HTTPRangeOpener, href: str):
+        self._opener = opener
+        self._href = href
+        self._size = opener.size(href)
+        self._pos = 0
+        self.closed = False
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self._size - self._pos
+        data = self._opener.read(self._href, self._pos, size)
+        self._pos += len(data)
+        return data
+
+    def get_byte_ranges(self, offsets, sizes) -> List[bytes]:
+        return self._opener.read_ranges(self._href, offsets, sizes)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self._size
+        self._pos = offset
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def close(self) -> None:
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
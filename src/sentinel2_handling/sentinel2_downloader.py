@@ -1,71 +1,381 @@
+import os
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import List, Tuple
+from functools import partial
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
 
-import planetary_computer
-import pystac_client
-from joblib import Parallel, delayed
+import pystac
 
+from src.sentinel2_handling import instrumentation
+from src.sentinel2_handling.base_classes.raster import Raster
+from src.sentinel2_handling.base_classes.sentinel2_bands import Sentinel2L2ABands
+from src.sentinel2_handling.base_classes.shared_raster import SharedRasterDescriptor
+from src.sentinel2_handling.remote_io import HTTPRangeOpener
+from src.sentinel2_handling.stac_cache import MPC_STAC_URL, S2_COLLECTION
 from src.sentinel2_handling.stac_item_sentinel2_processor import (
     StacItemSentinel2Processor,
+    TieredScreening,
+    get_max_concurrent_reads,
+    get_remote_opener,
+    set_max_concurrent_reads,
+    set_remote_opener,
 )
 
+SCREENING_TIERS = ("metadata", "overview", "full")
 
-def query_sentinel2(bbox, max_cloud_cover=80, end_date=None, num_days_before_end=30):
+
+@dataclass
+class ItemScreeningResult:
+    # what a screening worker sends back instead of a pickled processor
+    metadata: Optional[Tuple[str, float, float]]  # (date, eo:cloud_cover, usable %)
+    # clipped SCL, reused by the full load. A descriptor when sent via shared memory.
+    scl_raster: Optional[Union[Raster, SharedRasterDescriptor]] = None
+    tier: str = "full"  # which TieredScreening tier decided the item
+
+    @property
+    def is_usable(self) -> bool:
+        return self.metadata is not None
+
+
+def query_sentinel2(
+    bbox, max_cloud_cover=80, end_date=None, num_days_before_end=30, cache=None
+):
     """
     Query Sentinel-2 images for a given bounding box and cloud cover threshold.
+    With a StacSearchCache only dates not searched before go to the API, and the
+    items come back unsigned (the processors sign hrefs when they read them).
     """
-    # Set up the STAC API client
-    catalog = pystac_client.Client.open(
-        "https://planetarycomputer.microsoft.com/api/stac/v1",
-        modifier=planetary_computer.sign_inplace,
-    )
+    with instrumentation.stage("stac_search", cached=cache is not None) as timed:
+        items = list(
+            iter_sentinel2_items(
+                bbox,
+                max_cloud_cover=max_cloud_cover,
+                end_date=end_date,
+                num_days_before_end=num_days_before_end,
+                cache=cache,
+            )
+        )
+        timed.add(items=len(items))
+    # reverse the list because MPC returns newest results first.
+    return items[::-1]
 
+
+def iter_sentinel2_items(
+    bbox, max_cloud_cover=80, end_date=None, num_days_before_end=30, cache=None
+) -> Iterator[pystac.Item]:
+    """
+    Same search as query_sentinel2, but yields items newest first as each result
+    page arrives instead of waiting for the whole date range.
+    """
     # Create a search query
     if end_date is None:
         end_date = datetime.now()
 
     start_date = end_date - timedelta(days=num_days_before_end)
 
+    if cache is not None:
+        items = cache.search(
+            bbox, start_date, end_date, max_cloud_cover=max_cloud_cover
+        )
+        yield from reversed(items)
+        return
+
+    # Set up the STAC API client
+    import planetary_computer
+    import pystac_client
+
+    catalog = pystac_client.Client.open(
+        MPC_STAC_URL,
+        modifier=planetary_computer.sign_inplace,
+    )
+
     search = catalog.search(
-        collections=["sentinel-2-l2a"],
+        collections=[S2_COLLECTION],
         bbox=bbox,
         datetime=f"{start_date.isoformat()}/{end_date.isoformat()}",
         query={"eo:cloud_cover": {"lt": max_cloud_cover}},
     )
-
-    # reverse the list because MPC returns newest results first.
-    return list(search.get_items())[::-1]
+    yield from search.items()
 
 
 def filter_item_list(
-    item_list, bbox, min_usable_pct=85, njobs=-1
+    item_list,
+    bbox,
+    min_usable_pct=85,
+    njobs=-1,
+    cache=None,
+    screening=None,
+    shared_memory=False,
+    max_concurrent_reads: Optional[int] = None,
 ) -> Tuple[List[str], List[StacItemSentinel2Processor]]:
+    """
+    shared_memory: workers return the clipped SCL rasters in shared memory blocks
+        instead of pickling them, and the processors here view them without copying.
+    max_concurrent_reads: in-flight asset reads allowed across all worker processes,
+        split evenly between them, as each process has its own cap. Defaults to the
+        cap of this process (set_max_concurrent_reads). Tasks that run in this
+        process, e.g. with njobs=1, keep using its cap.
+
+    An opener set with set_remote_opener is rebuilt from its settings in each
+    worker process, as workers don't inherit it.
+    """
+    from joblib import Parallel, delayed, effective_n_jobs
+
     good_item_metadata = []
     good_item_processors = []
 
-    results = Parallel(n_jobs=njobs)(
-        delayed(get_processor_and_metadata)(
-            item=item, bbox=bbox, min_usable_pct=min_usable_pct
+    instrumented = instrumentation.is_enabled()
+    screen = screen_item
+    if instrumented:
+        # workers record stages in their own process and send them back with results
+        screen = partial(instrumentation.call_with_records, screen_item)
+    if max_concurrent_reads is None:
+        max_concurrent_reads = get_max_concurrent_reads()
+    reads_per_worker = max(1, max_concurrent_reads // effective_n_jobs(njobs))
+    opener = get_remote_opener()
+    opener_settings = None if opener is None else opener.settings()
+    # tasks return their exception instead of raising it, so that a failed item does
+    # not abort the run before the shared memory blocks of the others are discarded
+    outcomes = Parallel(n_jobs=njobs)(
+        delayed(_screen_task)(
+            os.getpid(),
+            reads_per_worker,
+            opener_settings,
+            screen,
+            item=item,
+            bbox=bbox,
+            min_usable_pct=min_usable_pct,
+            cache=cache,
+            screening=screening,
+            shared_memory=shared_memory,
         )
         for item in item_list
     )
-
-    for res in results:
-        if res[0] is None:
+    results, errors = [], []
+    for value, error, lookups in outcomes:
+        if lookups is not None:
+            cache.add_lookups(*lookups)
+        if error is not None:
+            errors.append(error)
             continue
-        good_item_metadata.append(res[0])
-        good_item_processors.append(res[1])
+        if instrumented:
+            value, records = value
+            instrumentation.add_records(records)
+        results.append(value)
+    if errors:
+        _discard_shared(results)
+        raise errors[0]
+
+    # processors are rebuilt here from the items we already hold
+    try:
+        for n, (item, res) in enumerate(zip(item_list, results)):
+            if not res.is_usable:
+                continue
+            good_item_metadata.append(res.metadata)
+            good_item_processors.append(_processor_from_result(item, bbox, res, cache))
+    except BaseException:
+        _discard_shared(results[n:])
+        raise
 
     print(
         f"List filtered as {len(good_item_metadata)} out of {len(item_list)} items orginally"
     )
+    if screening is not None:
+        tier_counts = Counter(res.tier for res in results)
+        print(
+            "Decided by tier: "
+            + ", ".join(f"{tier} {tier_counts[tier]}" for tier in SCREENING_TIERS)
+        )
     return (good_item_metadata, good_item_processors)
 
 
-def get_processor_and_metadata(item, bbox, min_usable_pct):
+def _screen_task(parent_pid, reads_per_worker, opener_settings, screen, **kwargs):
+    # (result, exception, cache lookups). Worker processes don't inherit the
+    # caller's read cap and remote opener, so they get their share of the cap and an
+    # opener of their own, and report the (hits, misses) made on their copy of the
+    # cache for the caller to add up.
+    if os.getpid() == parent_pid:
+        return _run_catching(screen, **kwargs) + (None,)
+
+    if get_max_concurrent_reads() != reads_per_worker:
+        set_max_concurrent_reads(reads_per_worker)
+    _set_worker_opener(opener_settings)
+    cache = kwargs.get("cache")
+    if cache is None:
+        return _run_catching(screen, **kwargs) + (None,)
+    hits, misses = cache.hits, cache.misses
+    outcome = _run_catching(screen, **kwargs)
+    return outcome + ((cache.hits - hits, cache.misses - misses),)
+
+
+def _set_worker_opener(opener_settings: Optional[dict]) -> None:
+    # kept across tasks, so its connections and cached headers are reused
+    opener = get_remote_opener()
+    if opener_settings is None:
+        if opener is not None:
+            set_remote_opener(None)
+    elif opener is None or opener.settings() != opener_settings:
+        set_remote_opener(HTTPRangeOpener(**opener_settings))
+
+
+def _run_catching(fn, *args, **kwargs):
+    # (result, None), or (None, exception) if fn raised
+    try:
+        return fn(*args, **kwargs), None
+    except Exception as e:
+        return None, e
+
+
+def _discard_shared(results: List[ItemScreeningResult]) -> None:
+    # blocks that were not attached yet would outlive this process
+    for res in results:
+        if isinstance(res.scl_raster, SharedRasterDescriptor):
+            res.scl_raster.discard()
+
+
+def stream_filter_items(
+    items: Iterable[pystac.Item],
+    bbox,
+    min_usable_pct=85,
+    max_workers=4,
+    max_pending=None,
+    ordered=False,
+    cache=None,
+    screening: Optional[TieredScreening] = None,
+    tier_counts: Optional[dict] = None,
+) -> Iterator[Tuple[Tuple[str, float, float], StacItemSentinel2Processor]]:
+    """
+    Streaming version of filter_item_list: screens items as they are pulled from
+    items (e.g. iter_sentinel2_items) and yields (metadata, processor) for each
+    usable item as soon as it is screened.
+
+    At most max_pending items (default 2 * max_workers) are in flight or waiting to
+    be yielded, so memory stays flat however long items is. Screening is mostly
+    waiting on reads, so it runs on threads. Results come in completion order, or
+    in input order if ordered; sort by metadata[0] afterwards to get them by date.
+    If tier_counts is given, it is updated with how many items each screening tier
+    decided as they are yielded.
+    """
+    if max_pending is None:
+        max_pending = 2 * max_workers
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    done_queue = queue.Queue()
+    slots = threading.Semaphore(max_pending)
+    stop = threading.Event()
+
+    def produce():
+        # pulls items on its own thread, so a slow search never delays screening
+        count = 0
+        try:
+            for item in items:
+                slots.acquire()
+                if stop.is_set():
+                    return
+                future = pool.submit(
+                    screen_item, item, bbox, min_usable_pct, cache, screening
+                )
+                future.add_done_callback(
+                    lambda f, seq=count, item=item: done_queue.put((seq, item, f))
+                )
+                count += 1
+        except Exception as e:
+            done_queue.put((None, e, None))
+        done_queue.put((None, count, None))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        total, received, next_seq, held = None, 0, 0, {}
+        while total is None or received < total:
+            seq, item, future = done_queue.get()
+            if seq is None:
+                if isinstance(item, Exception):
+                    raise item
+                total = item
+                continue
+            received += 1
+
+            held[seq] = (item, future)
+            if not ordered:
+                next_seq = seq
+            while next_seq in held:
+                item, future = held.pop(next_seq)
+                slots.release()
+                if ordered:
+                    next_seq += 1
+                res = future.result()
+                if tier_counts is not None:
+                    tier_counts[res.tier] = tier_counts.get(res.tier, 0) + 1
+                if res.is_usable:
+                    yield res.metadata, _processor_from_result(item, bbox, res, cache)
+    finally:
+        # the consumer may stop early, so don't screen what is still queued
+        stop.set()
+        slots.release()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _processor_from_result(
+    item, bbox, res: ItemScreeningResult, cache=None
+) -> StacItemSentinel2Processor:
+    # items decided without a full SCL read have nothing to preload
+    preloaded_bands = None
+    scl_raster = res.scl_raster
+    if isinstance(scl_raster, SharedRasterDescriptor):
+        scl_raster = Raster.from_shared_memory(scl_raster)
+    if scl_raster is not None:
+        preloaded_bands = {Sentinel2L2ABands.SCL: scl_raster}
+    return StacItemSentinel2Processor(
+        item=item, bbox=bbox, cache=cache, preloaded_bands=preloaded_bands
+    )
+
+
+def screen_item(
+    item, bbox, min_usable_pct, cache=None, screening=None, shared_memory=False
+) -> ItemScreeningResult:
+    res = _screen_item(item, bbox, min_usable_pct, cache, screening)
+    if shared_memory and res.scl_raster is not None:
+        res.scl_raster = res.scl_raster.to_shared_memory()
+    return res
+
+
+def _screen_item(item, bbox, min_usable_pct, cache, screening) -> ItemScreeningResult:
+    if screening is None:
+        metadata, item_proc = get_processor_and_metadata(
+            item=item, bbox=bbox, min_usable_pct=min_usable_pct, cache=cache
+        )
+        if metadata is None:
+            return ItemScreeningResult(metadata=None)
+        return ItemScreeningResult(
+            metadata=metadata, scl_raster=item_proc.s2_bands[Sentinel2L2ABands.SCL]
+        )
+
+    item_proc = StacItemSentinel2Processor(item=item, bbox=bbox, cache=cache)
+    usable_pixel_percentage, tier, accepted = item_proc.screen_usable_pixels(
+        min_usable_pct, screening
+    )
+    if not accepted:
+        return ItemScreeningResult(metadata=None, tier=tier)
+    metadata = (
+        item.properties["datetime"][:10],
+        item.properties["eo:cloud_cover"],
+        usable_pixel_percentage,
+    )
+    return ItemScreeningResult(
+        metadata=metadata,
+        scl_raster=item_proc.s2_bands.get(Sentinel2L2ABands.SCL),
+        tier=tier,
+    )
+
+
+def get_processor_and_metadata(item, bbox, min_usable_pct, cache=None):
     item_date = item.properties["datetime"][:10]
     prev_cloud_cover = item.properties["eo:cloud_cover"]
-    item_proc = StacItemSentinel2Processor(item=item, bbox=bbox)
+    item_proc = StacItemSentinel2Processor(item=item, bbox=bbox, cache=cache)
     usable_pixel_percentage = item_proc.compute_usable_pixels()
     if usable_pixel_percentage < min_usable_pct:
         return (None, None)
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple
+
+import pystac
+
+MPC_STAC_URL = "https://planetarycomputer.microsoft.com/api/stac/v1"
+S2_COLLECTION = "sentinel-2-l2a"
+
+
+def _to_utc_naive(date: datetime) -> datetime:
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def _item_datetime(item: Dict) -> datetime:
+    return _to_utc_naive(
+        datetime.fromisoformat(item["properties"]["datetime"].replace("Z", "+00:00"))
+    )
+
+
+class StacSearchCache:
+    """
+    Local cache of STAC search results, one directory per collection, bbox and
+    cloud cover threshold. Items are stored unsigned as JSON together with the date
+    range already searched, so a later search only asks the API for dates it has not
+    covered yet (and from the newest cached item on, to pick up late ingests).
+
+    Asset hrefs are signed when they are read, by the processors, so cached items
+    never hold expired tokens.
+
+    client: anything with pystac_client.Client's search(), e.g. a stub in tests.
+    """
+
+    ITEMS_FILE = "items.json"
+    COVERAGE_FILE = "coverage.json"
+
+    def __init__(
+        self,
+        cache_dir: str,
+        catalog_url: str = MPC_STAC_URL,
+        collection: str = S2_COLLECTION,
+        client=None,
+    ):
+        self.cache_dir = cache_dir
+        self.catalog_url = catalog_url
+        self.collection = collection
+        self.api_searches = 0
+        self.items_fetched = 0
+        self._client = client
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __getstate__(self):
+        # neither the lock nor the HTTP client pickle
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_client"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            import pystac_client
+
+            self._client = pystac_client.Client.open(self.catalog_url)
+        return self._client
+
+    def make_key(self, bbox, max_cloud_cover) -> str:
+        # round so float noise in the bbox does not split the cache
+        bbox = [round(float(v), 6) for v in bbox]
+        key = json.dumps([self.catalog_url, self.collection, bbox, max_cloud_cover])
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _load(self, key) -> Tuple[Dict, Dict[str, Dict]]:
+        key_dir = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(key_dir, self.COVERAGE_FILE)) as f:
+                coverage = json.load(f)
+            with open(os.path.join(key_dir, self.ITEMS_FILE)) as f:
+                items = json.load(f)
+        except FileNotFoundError:
+            return {}, {}
+        return coverage, {item["id"]: item for item in items}
+
+    def _save(self, key, coverage: Dict, items: Dict[str, Dict]) -> None:
+        key_dir = os.path.join(self.cache_dir, key)
+        os.makedirs(key_dir, exist_ok=True)
+        # items first, so coverage never claims dates whose items are not written
+        for name, content in [
+            (self.ITEMS_FILE, list(items.values())),
+            (self.COVERAGE_FILE, coverage),
+        ]:
+            path = os.path.join(key_dir, name)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(content, f)
+            os.replace(tmp_path, path)
+
+    def _search_api(self, bbox, max_cloud_cover, start, end) -> List[Dict]:
+        self.api_searches += 1
+        search = self.client.search(
+            collections=[self.collection],
+            bbox=bbox,
+            datetime=f"{start.isoformat()}/{end.isoformat()}",
+            query={"eo:cloud_cover": {"lt": max_cloud_cover}},
+        )
+        items = list(search.items_as_dicts())
+        self.items_fetched += len(items)
+        return items
+
+    def _missing_ranges(
+        self, coverage: Dict, items: Dict[str, Dict], start: datetime, end: datetime
+    ) -> List[Tuple[datetime, datetime]]:
+        if not coverage:
+            return [(start, end)]
+
+        covered_start = datetime.fromisoformat(coverage["start"])
+        covered_end = datetime.fromisoformat(coverage["end"])
+        ranges = []
+        if start < covered_start:
+            ranges.append((start, covered_start))
+        if end > covered_end:
+            newest = max(
+                (_item_datetime(item) for item in items.values()), default=None
+            )
+            refresh_from = covered_end if newest is None else min(newest, covered_end)
+            ranges.append((refresh_from, end))
+        return ranges
+
+    def search(
+        self, bbox, start_date: datetime, end_date: datetime, max_cloud_cover=80
+    ) -> List[pystac.Item]:
+        """Items between start_date and end_date, oldest first, hrefs unsigned."""
+        start, end = _to_utc_naive(start_date), _to_utc_naive(end_date)
+        key = self.make_key(bbox, max_cloud_cover)
+
+        with self._lock:
+            coverage, items = self._load(key)
+            ranges = self._missing_ranges(coverage, items, start, end)
+            for range_start, range_end in ranges:
+                for item in self._search_api(
+                    bbox, max_cloud_cover, range_start, range_end
+                ):
+                    items[item["id"]] = item
+
+            if ranges:
+                if coverage:
+                    start_covered = min(
+                        start, datetime.fromisoformat(coverage["start"])
+                    )
+                    end_covered = max(end, datetime.fromisoformat(coverage["end"]))
+                else:
+                    start_covered, end_covered = start, end
+                coverage = {
+                    "start": start_covered.isoformat(),
+                    "end": end_covered.isoformat(),
+                }
+                self._save(key, coverage, items)
+
+        selected = [
+            item for item in items.values() if start <= _item_datetime(item) <= end
+        ]
+        selected.sort(key=lambda item: (_item_datetime(item), item["id"]))
+        return [pystac.Item.from_dict(item) for item in selected]
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in os.listdir(self.cache_dir):
+                key_dir = os.path.join(self.cache_dir, key)
+                for name in (self.ITEMS_FILE, self.COVERAGE_FILE):
+                    if os.path.exists(os.path.join(key_dir, name)):
+                        os.remove(os.path.join(key_dir, name))
@@ -1,23 +1,152 @@
-from typing import Dict, List
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
 
-import geopandas as gpd
 import numpy as np
 import pystac
 import rasterio
 import rasterio.mask
+from affine import Affine
+from rasterio.enums import Resampling
+from rasterio.features import geometry_mask
+from rasterio.windows import Window
+from shapely import affinity, unary_union
 from shapely.geometry import box
 
+from src.sentinel2_handling import instrumentation
+from src.sentinel2_handling.base_classes.aoi import AOI
+from src.sentinel2_handling.base_classes.packed_mask import PackedMask
 from src.sentinel2_handling.base_classes.raster import Raster
 from src.sentinel2_handling.base_classes.sentinel2_bands import Sentinel2L2ABands
 from src.sentinel2_handling.base_classes.spectral_indices import (
+    CLOUD_SCL_CLASSES,
     Sentinel2SpectralIndices,
 )
+from src.sentinel2_handling.raster_cache import RasterDiskCache
+from src.sentinel2_handling.remote_io import HTTPRangeOpener
+
+# caps the number of in-flight asset reads across all items in this process
+_max_concurrent_reads = 8
+_read_semaphore = threading.BoundedSemaphore(_max_concurrent_reads)
+_remote_opener: Optional[HTTPRangeOpener] = None
+
+
+def set_max_concurrent_reads(max_reads: int) -> None:
+    global _read_semaphore, _max_concurrent_reads
+    _max_concurrent_reads = max_reads
+    _read_semaphore = threading.BoundedSemaphore(max_reads)
+
+
+def get_max_concurrent_reads() -> int:
+    return _max_concurrent_reads
+
+
+def sign_href(href: str) -> str:
+    """
+    Signs Planetary Computer blob hrefs right before they are read. Other hrefs, and
+    hrefs that are already signed, are returned unchanged. Tokens are cached per
+    storage container by planetary_computer.
+    """
+    if urlsplit(href).scheme not in ("http", "https"):
+        return href
+    # imported on first use, local reads never need it
+    import planetary_computer
+
+    with instrumentation.stage("sign"):
+        return planetary_computer.sign_url(href)
+
+
+def set_remote_opener(opener: Optional[HTTPRangeOpener]) -> None:
+    """
+    Routes http(s) asset reads in this process through a shared HTTPRangeOpener
+    (pooled connections, cached headers, request counters). None restores GDAL's
+    own /vsicurl/ reads. filter_item_list workers build their own opener with the
+    same settings, whose counters stay in the worker.
+    """
+    global _remote_opener
+    _remote_opener = opener
+
+
+def get_remote_opener() -> Optional[HTTPRangeOpener]:
+    return _remote_opener
+
+
+def open_href(href: str):
+    href = sign_href(href)
+    with instrumentation.stage("open"):
+        if _remote_opener is None or urlsplit(href).scheme not in ("http", "https"):
+            return rasterio.open(href)
+        # don't let GDAL probe the server for .aux.xml/.msk sidecars
+        with rasterio.Env(GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR"):
+            return rasterio.open(href, opener=_remote_opener)
+
+
+def _snap_window_to_blocks(
+    window: Window, block_shape: Tuple[int, int], width: int, height: int
+) -> Window:
+    # grow the window outwards to the COG's internal tile grid
+    block_h, block_w = block_shape
+    row_start = (int(window.row_off) // block_h) * block_h
+    col_start = (int(window.col_off) // block_w) * block_w
+    row_stop = min(
+        math.ceil((window.row_off + window.height) / block_h) * block_h, height
+    )
+    col_stop = min(
+        math.ceil((window.col_off + window.width) / block_w) * block_w, width
+    )
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def _shapes_cover_window(shapes, transform: Affine, shape: Tuple[int, int]) -> bool:
+    # masking is a no-op when every pixel centre of the window is inside the shapes
+    height, width = shape
+    pixel_geom = affinity.affine_transform(
+        unary_union(shapes), (~transform).to_shapely()
+    )
+    pixel_centres = box(0.5, 0.5, width - 0.5, height - 0.5)
+    return pixel_geom.covers(pixel_centres)
+
+
+def mask_outside_shapes(img: np.ndarray, shapes, transform: Affine, nodata) -> None:
+    # sets pixels whose centre is outside the shapes to nodata, in place
+    if _shapes_cover_window(shapes, transform, img.shape):
+        return
+    outside = geometry_mask(shapes, transform=transform, out_shape=img.shape)
+    img[outside] = 0 if nodata is None else nodata
+
+
+@dataclass
+class TieredScreening:
+    """
+    Settings for deciding whether an item is usable in tiers, cheapest first:
+
+    metadata: the item's tile-wide eo:cloud_cover. Items above metadata_reject_above
+        are rejected and items below metadata_accept_below accepted (None disables
+        either) without reading anything.
+    overview: usable % estimated from the SCL read overview_factor times coarser,
+        which GDAL serves from the COG overviews. Decides items whose estimate is
+        more than tolerance (percentage points) away from the threshold. Skipped
+        when the processor's cache already holds the clipped SCL.
+    full: the full-resolution SCL read, for the items in between.
+    """
+
+    metadata_reject_above: Optional[float] = 95.0
+    metadata_accept_below: Optional[float] = None
+    overview_factor: int = 8
+    tolerance: float = 10.0
 
 
 class StacItemSentinel2Processor:
     _item: pystac.item.Item
     _bbox: List
-    _clip_gdf: gpd.GeoDataFrame
+    _aoi: AOI
+    _windowed_read: bool
+    _snap_to_blocks: bool
+    _cache: Optional[RasterDiskCache]
+    _max_workers: Optional[int]
 
     # sentinel 2 meta-data
     partial_meta_10m: Dict
@@ -34,76 +163,255 @@ class StacItemSentinel2Processor:
         Sentinel2L2ABands.SWIR1,
         Sentinel2L2ABands.SCL,
     ]
-    s2_bands: Dict[str, Raster]
+    s2_bands: Dict[Sentinel2L2ABands, Raster]
+    spectral_indices: Optional[Sentinel2SpectralIndices] = None
     _bands_loaded: bool = False
 
-    def __init__(self, item, bbox):
+    def __init__(
+        self,
+        item,
+        bbox,
+        windowed_read=True,
+        snap_to_blocks=False,
+        cache=None,
+        max_workers=None,
+        preloaded_bands=None,
+    ):
+        """
+        windowed_read: read only the pixel window of the bbox instead of going through
+            rasterio.mask. Polygon masking is only applied when the reprojected bbox
+            does not cover the whole window.
+        snap_to_blocks: grow the read window to the COG's internal tile grid. The
+            returned rasters then cover whole blocks rather than just the bbox.
+        cache: optional RasterDiskCache. Clipped assets found in it are not re-read.
+        max_workers: number of threads loading this item's bands. Defaults to one per
+            band. The process-wide cap is set with set_max_concurrent_reads.
+        preloaded_bands: already clipped rasters keyed by Sentinel2L2ABands, e.g. the
+            SCL raster read during screening. These are not read again.
+        """
         self._item = item
         if len(bbox) != 4:
             raise ValueError("Nope. the bbox should be a 4 tuple.")
 
-        # create the bbox.
+        # create the bbox, shared with every other item over the same AOI.
         self._bbox = bbox
-        self._clip_gdf = gpd.GeoDataFrame({"geometry": [box(*bbox)]}, crs="epsg:4326")
+        self._aoi = AOI.from_bbox(bbox)
+        self._windowed_read = windowed_read
+        self._snap_to_blocks = snap_to_blocks
+        self._cache = cache
+        self._max_workers = max_workers
+        self.s2_bands = dict(preloaded_bands or {})
 
     def __load_and_clip_asset(self, asset, asset_name) -> Raster:
-        with rasterio.open(asset.href) as src:
-            # Reproject if necessary
-            if self._clip_gdf.crs != src.crs:
-                self._clip_gdf = self._clip_gdf.to_crs(src.crs)
-
-            # Mask the raster with the bbox
-            out_image, out_transform = rasterio.mask.mask(
-                src, self._clip_gdf.geometry, crop=True
-            )
+        # GDAL releases the GIL while reading, so band reads can overlap.
+        with _read_semaphore, open_href(asset.href) as src:
+            with instrumentation.stage("read") as timed:
+                if self._windowed_read:
+                    out_image, out_transform = self.__read_window(src)
+                else:
+                    # Mask the raster with the bbox
+                    out_image, out_transform = rasterio.mask.mask(
+                        src, self._aoi.shapes(src.crs), crop=True
+                    )
+                    out_image = out_image[0]
+                timed.add(bytes_read=out_image.nbytes)
 
             out_meta = src.meta.copy()
             out_meta.update(
                 {
-                    "height": out_image[0].shape[0],
-                    "width": out_image[0].shape[1],
+                    "height": out_image.shape[0],
+                    "width": out_image.shape[1],
                     "transform": out_transform,
                 }
             )
-            # convert img to HxW
-            return Raster(img=out_image[0], meta=out_meta, band_names=[asset_name])
+            # img is HxW
+            return Raster(img=out_image, meta=out_meta, band_names=[asset_name])
 
-    def _load_and_clip_required_assets(self, only_rgb=False) -> None:
-        if only_rgb:
-            assets_to_load = self.S2_RGB
-        else:
-            assets_to_load = self.S2_ASSET_NAMES
+    def __read_window(self, src) -> Tuple[np.ndarray, Affine]:
+        # the AOI polygon in the tile CRS and its window, cached per CRS and grid
+        shapes = self._aoi.shapes(src.crs)
+        window = self._aoi.window(
+            src.crs, src.transform, width=src.width, height=src.height
+        )
 
-        self.s2_bands = {
-            asset_name: self.__load_and_clip_asset(
-                asset=self._item.assets[asset_name.value], asset_name=asset_name.value
+        if self._snap_to_blocks:
+            window = _snap_window_to_blocks(
+                window, src.block_shapes[0], width=src.width, height=src.height
             )
-            for asset_name in assets_to_load
-        }
+
+        # only the COG blocks intersecting the window are fetched
+        out_image = src.read(1, window=window)
+        out_transform = src.window_transform(window)
+
+        mask_outside_shapes(out_image, shapes, out_transform, src.nodata)
+        return out_image, out_transform
+
+    def _target_crs(self, asset) -> Optional[str]:
+        # known from the STAC metadata, so cache lookups need no network I/O
+        for fields in (asset.extra_fields, self._item.properties):
+            if fields.get("proj:code") is not None:
+                return fields["proj:code"]
+            if fields.get("proj:epsg") is not None:
+                return f"EPSG:{fields['proj:epsg']}"
+        return None
+
+    def _get_clipped_asset(self, asset_name: Sentinel2L2ABands) -> Raster:
+        with instrumentation.scope(item=self._item.id, band=asset_name.value):
+            with instrumentation.stage("load_band"):
+                return self.__get_clipped_asset(asset_name)
+
+    def __get_clipped_asset(self, asset_name: Sentinel2L2ABands) -> Raster:
+        asset = self._item.assets[asset_name.value]
+        if self._cache is None:
+            return self.__load_and_clip_asset(asset=asset, asset_name=asset_name.value)
+
+        cache_key = self._cache_key(asset_name)
+        raster = self._cache.get(cache_key)
+        if raster is None:
+            raster = self.__load_and_clip_asset(
+                asset=asset, asset_name=asset_name.value
+            )
+            self._cache.put(cache_key, raster)
+        return raster
+
+    def _cache_key(self, asset_name: Sentinel2L2ABands) -> str:
+        return self._cache.make_key(
+            item_id=self._item.id,
+            asset_key=asset_name.value,
+            bbox=self._bbox,
+            crs=self._target_crs(self._item.assets[asset_name.value]),
+            read_mode=f"windowed={self._windowed_read},snap={self._snap_to_blocks}",
+        )
+
+    def _load_and_clip_required_assets(
+        self, only_rgb=False, assets_to_load=None
+    ) -> None:
+        if assets_to_load is None:
+            assets_to_load = self.S2_RGB if only_rgb else self.S2_ASSET_NAMES
+
+        # skip bands that are already loaded, e.g. SCL from screening
+        assets_to_load = [a for a in assets_to_load if a not in self.s2_bands]
+        if assets_to_load:
+            max_workers = self._max_workers or len(assets_to_load)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                rasters = executor.map(self._get_clipped_asset, assets_to_load)
+                self.s2_bands.update(zip(assets_to_load, rasters))
         self._bands_loaded = True
 
-    def _compute_spectral_indices(self, only_rgb=False) -> Sentinel2SpectralIndices:
-        # indices are computed on initialization
-        return Sentinel2SpectralIndices(self.s2_bands, only_rgb=only_rgb)
+    def _load_bands(
+        self, bands: List[Sentinel2L2ABands]
+    ) -> Dict[Sentinel2L2ABands, Raster]:
+        self._load_and_clip_required_assets(assets_to_load=bands)
+        return {band: self.s2_bands[band] for band in bands}
+
+    def _compute_spectral_indices(self, dtype=np.float32) -> Sentinel2SpectralIndices:
+        # indices are computed on first access, loading the bands they need
+        return Sentinel2SpectralIndices(
+            self.s2_bands,
+            dtype=dtype,
+            band_loader=self._load_bands,
+            item_id=self._item.id,
+        )
 
     def load_and_compute_spectral_indices(
-        self, only_rgb=False
+        self, only_rgb=False, indices=None, dtype=np.float32
     ) -> Sentinel2SpectralIndices:
-        self._load_and_clip_required_assets(only_rgb=only_rgb)
-        return self._compute_spectral_indices(only_rgb=only_rgb)
+        """
+        Returns the item's spectral indices. Each one is computed on first access and
+        only reads the bands it depends on.
+        indices: attributes to compute right away, e.g. ["ndvi", "cloud_mask"]. Their
+            bands are loaded together.
+        only_rgb: shorthand for indices=["rgb_image"].
+        """
+        if self.spectral_indices is None:
+            self.spectral_indices = self._compute_spectral_indices(dtype=dtype)
+        if only_rgb:
+            indices = ["rgb_image"]
+        if indices:
+            self.spectral_indices.compute(*indices)
+        return self.spectral_indices
 
-    def compute_usable_pixels(self) -> float:
-        if self._bands_loaded:
-            cloud_mask = self.spectral_indices.cloud_mask.img
-        else:
-            scl_raster = self.__load_and_clip_asset(
-                asset=self._item.assets[Sentinel2L2ABands.SCL.value],
-                asset_name=Sentinel2L2ABands.SCL.value,
+    def estimate_usable_pixels(self, overview_factor: int = 8) -> float:
+        """
+        Usable % from the SCL read overview_factor times coarser than native, so
+        only an overview level is fetched. Pixels outside the AOI count as unusable,
+        as in compute_usable_pixels.
+        """
+        asset = self._item.assets[Sentinel2L2ABands.SCL.value]
+        with instrumentation.scope(
+            item=self._item.id, band=Sentinel2L2ABands.SCL.value
+        ), instrumentation.stage("estimate_usable_pixels"):
+            return self.__estimate_usable_pixels(asset, overview_factor)
+
+    def __estimate_usable_pixels(self, asset, overview_factor: int) -> float:
+        with _read_semaphore, open_href(asset.href) as src:
+            window = self._aoi.window(
+                src.crs, src.transform, width=src.width, height=src.height
             )
-            cloud_mask = Sentinel2SpectralIndices.compute_cloud_mask(
-                scl_raster=scl_raster, resample_to_ref=False
-            ).img
+            out_shape = (
+                max(1, math.ceil(window.height / overview_factor)),
+                max(1, math.ceil(window.width / overview_factor)),
+            )
+            # a read stage like the full tier's, so both tiers' I/O shows up together
+            with instrumentation.stage(
+                "read", overview_factor=overview_factor
+            ) as timed:
+                scl = src.read(
+                    1, window=window, out_shape=out_shape, resampling=Resampling.nearest
+                )
+                timed.add(bytes_read=scl.nbytes)
+            transform = src.window_transform(window) @ Affine.scale(
+                window.width / out_shape[1], window.height / out_shape[0]
+            )
+            mask_outside_shapes(scl, self._aoi.shapes(src.crs), transform, src.nodata)
+
+        cloud_mask = PackedMask.from_array(np.isin(scl, CLOUD_SCL_CLASSES))
+        return cloud_mask.clear_pct()
+
+    def screen_usable_pixels(
+        self, min_usable_pct: float, screening: TieredScreening
+    ) -> Tuple[float, str, bool]:
+        """
+        (usable %, tier, accepted) from the cheapest tier that is conclusive, tier
+        being "metadata", "overview" or "full". Only the full tier's % is exact:
+        metadata gives 100 - eo:cloud_cover and overview its estimate, so use
+        accepted rather than comparing the % with min_usable_pct again.
+        """
+        cloud_cover = self._item.properties.get("eo:cloud_cover")
+        if cloud_cover is not None:
+            reject, accept = (
+                screening.metadata_reject_above,
+                screening.metadata_accept_below,
+            )
+            if reject is not None and cloud_cover > reject:
+                return 100 - cloud_cover, "metadata", False
+            if accept is not None and cloud_cover < accept:
+                return 100 - cloud_cover, "metadata", True
 
-        usable_pixels = np.sum(cloud_mask == 0)
-        total_pixels = cloud_mask.size
-        return usable_pixels / total_pixels * 100
+        # a cached clipped SCL makes the exact tier cheaper than the overview read
+        scl_cached = self._cache is not None and (
+            self._cache_key(Sentinel2L2ABands.SCL) in self._cache
+        )
+        if Sentinel2L2ABands.SCL not in self.s2_bands and not scl_cached:
+            estimate = self.estimate_usable_pixels(screening.overview_factor)
+            if abs(estimate - min_usable_pct) > screening.tolerance:
+                return estimate, "overview", estimate >= min_usable_pct
+
+        usable_pct = self.compute_usable_pixels()
+        return usable_pct, "full", usable_pct >= min_usable_pct
+
+    def compute_usable_pixels(self) -> float:
+        # computed on the native 20m SCL grid. The clipped SCL is kept so that the full
+        # load does not read it again.
+        scl_raster = self.s2_bands.get(Sentinel2L2ABands.SCL)
+        if scl_raster is None:
+            scl_raster = self._get_clipped_asset(Sentinel2L2ABands.SCL)
+            self.s2_bands[Sentinel2L2ABands.SCL] = scl_raster
+
+        with instrumentation.scope(item=self._item.id), instrumentation.stage(
+            "usable_pixels"
+        ):
+            cloud_mask = Sentinel2SpectralIndices.compute_packed_cloud_mask(
+                scl_raster=scl_raster, resample_to_ref=False
+            )
+            return cloud_mask.clear_pct()
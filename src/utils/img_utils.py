@@ -1,7 +1,9 @@
-import cv2
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
-from skimage.exposure import match_histograms
+
+# cv2 and skimage are slow to import, so the functions using them import them
 
 
 def resize_img(pil_image, factor):
@@ -34,10 +36,87 @@ def adjust_contrast_brightness(image, contrast=1.0, brightness=0.0):
 
 
 def match_images(ref_img, src_img):
+    from skimage.exposure import match_histograms
+
     matched_image = match_histograms(src_img, ref_img, channel_axis=-1)
     return matched_image
 
 
+class HistogramMatcher:
+    """
+    Histogram matching against one reference for many frames. The reference
+    quantiles are computed once. Integer frames are mapped through a per-channel
+    lookup table, float frames by interpolating their own quantiles. Same result
+    as match_images.
+
+    float_levels: if set, float frames use a source CDF binned into that many
+    levels instead of a full sort. Much faster, approximate in sparse tails.
+    """
+
+    def __init__(self, ref_img, float_levels=None):
+        self.num_channels = ref_img.shape[-1]
+        self.float_levels = float_levels
+        self._ref_quantiles = []
+        self._ref_values = []
+        for i in range(self.num_channels):
+            channel = ref_img[..., i].reshape(-1)
+            if channel.dtype.kind == "u":
+                counts = np.bincount(channel)
+                values = np.nonzero(counts)[0]
+                counts = counts[values]
+            else:
+                values, counts = np.unique(channel, return_counts=True)
+            self._ref_values.append(values)
+            self._ref_quantiles.append(np.cumsum(counts) / channel.size)
+
+    def _lookup_table(self, counts, i):
+        src_quantiles = np.cumsum(counts) / counts.sum()
+        return np.interp(src_quantiles, self._ref_quantiles[i], self._ref_values[i])
+
+    def _match_channel(self, channel, i):
+        if channel.dtype.kind == "u":
+            lut = self._lookup_table(np.bincount(channel.reshape(-1)), i)
+            return lut.astype(channel.dtype)[channel]
+
+        if self.float_levels:
+            # piecewise linear source CDF over float_levels bins, mapped once to
+            # reference values at the bin edges, then interpolated per pixel
+            lo, hi = channel.min(), channel.max()
+            scale = self.float_levels / (hi - lo) if hi > lo else 0.0
+            pos = (channel - lo) * scale
+            idx = np.minimum(pos.astype(np.intp), self.float_levels - 1)
+            pos -= idx
+            counts = np.bincount(idx.reshape(-1), minlength=self.float_levels)
+            cdf = np.concatenate([[0], np.cumsum(counts)]) / channel.size
+            edge_values = np.interp(cdf, self._ref_quantiles[i], self._ref_values[i])
+            lower = edge_values[idx]
+            return lower + pos * (edge_values[idx + 1] - lower)
+
+        _, lookup, counts = np.unique(
+            channel.reshape(-1), return_inverse=True, return_counts=True
+        )
+        return self._lookup_table(counts, i)[lookup].reshape(channel.shape)
+
+    def match(self, src_img):
+        if src_img.shape[-1] != self.num_channels:
+            raise ValueError("Number of channels in src_img and ref_img must match!")
+        out_dtype = np.float32 if src_img.dtype == np.float32 else src_img.dtype
+        matched = np.empty(src_img.shape, dtype=out_dtype)
+        for i in range(self.num_channels):
+            matched[..., i] = self._match_channel(src_img[..., i], i)
+        return matched
+
+    def match_batch(self, src_imgs, max_workers=None):
+        # numpy releases the GIL in the sort/bincount/take loops, so threads scale
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(self.match, src_imgs))
+
+
+def match_images_batch(ref_img, src_imgs, max_workers=None, float_levels=None):
+    matcher = HistogramMatcher(ref_img, float_levels=float_levels)
+    return matcher.match_batch(src_imgs, max_workers=max_workers)
+
+
 def normalize_image(img):
     """Normalize a 3D RGB image to the [0, 1] range based on the min and max of each channel."""
     # Normalize each channel independently
@@ -53,6 +132,8 @@ def convert_to_uint8(img):
 
 
 def apply_histogram_equalization(image):
+    import cv2
+
     # Apply histogram equalization on each channel separately
     equalized_image = np.empty_like(image)
     for i in range(3):
@@ -63,6 +144,8 @@ def apply_histogram_equalization(image):
 
 
 def apply_clahe(image, clip_limit=2.0, tile_grid_size=(8, 8)):
+    import cv2
+
     # Apply CLAHE on each channel separately
     clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid_size)
     clahe_image = np.empty_like(image)
@@ -71,3 +154,129 @@ def apply_clahe(image, clip_limit=2.0, tile_grid_size=(8, 8)):
             clahe.apply((image[..., i] * 255).astype(np.uint8)) / 255.0
         )
     return clahe_image
+
+
+class EnhancementPipeline:
+    """
+    Chain of enhancement steps run on one integer working buffer per frame, e.g. the
+    notebook's adjustments:
+
+        pipeline = (
+            EnhancementPipeline()
+            .normalize()
+            .clahe(tile_grid_size=(10, 10))
+            .contrast_brightness(contrast=1.05, brightness=0.1)
+            .channel_gain(2, gain=1.07, offset=0.03)
+            .channel_gain(1, gain=1.01, offset=0.01)
+        )
+        frames = pipeline.run_batch(raw_imgs)
+
+    The buffer is channels x h x w in uint8 (or uint16, except equalize_hist), so
+    OpenCV works on contiguous channels in place. Consecutive pointwise steps
+    (contrast_brightness, channel_gain) are fused into one lookup table. Parameters
+    are on the same [0, 1] scale as the float functions above. Frames come out as
+    h x w x channels in the pipeline's dtype.
+    """
+
+    def __init__(self, dtype=np.uint8):
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.uint8, np.uint16):
+            raise ValueError("EnhancementPipeline works on uint8 or uint16 buffers.")
+        self.max_value = np.iinfo(self.dtype).max
+        self.steps = []
+
+    def normalize(self):
+        # per-channel min/max scaling, like normalize_image
+        if self.steps:
+            raise ValueError("normalize must be the first step.")
+        self.steps.append(("normalize", None))
+        return self
+
+    def clahe(self, clip_limit=2.0, tile_grid_size=(8, 8)):
+        self.steps.append(("clahe", (clip_limit, tile_grid_size)))
+        return self
+
+    def equalize_hist(self):
+        if self.dtype != np.uint8:
+            raise ValueError("OpenCV only equalizes uint8 histograms.")
+        self.steps.append(("equalize_hist", None))
+        return self
+
+    def contrast_brightness(self, contrast=1.0, brightness=0.0):
+        self._add_pointwise(lambda x, c: contrast * x + brightness)
+        return self
+
+    def channel_gain(self, channel, gain=1.0, offset=0.0):
+        self._add_pointwise(lambda x, c: x * gain + offset if c == channel else x)
+        return self
+
+    def _add_pointwise(self, fn):
+        if self.steps and self.steps[-1][0] == "pointwise":
+            self.steps[-1][1].append(fn)
+        else:
+            self.steps.append(("pointwise", [fn]))
+
+    def _lookup_tables(self, fns, num_channels):
+        values = np.arange(self.max_value + 1) / self.max_value
+        tables = []
+        for c in range(num_channels):
+            table = values
+            for fn in fns:
+                table = np.clip(fn(table, c), 0, 1)
+            tables.append((table * self.max_value + 0.5).astype(self.dtype))
+        return tables
+
+    def _to_buffer(self, img, normalize):
+        buffer = np.empty((img.shape[-1],) + img.shape[:2], dtype=self.dtype)
+        for c in range(img.shape[-1]):
+            channel = img[..., c]
+            if normalize:
+                lo, hi = channel.min(), channel.max()
+                # a constant channel has no range to stretch, so it maps to 0
+                scale = self.max_value / (hi - lo) if hi > lo else 0.0
+            elif channel.dtype == self.dtype:
+                buffer[c] = channel
+                continue
+            else:
+                # floats are taken to be in [0, 1] already
+                lo, scale = 0.0, self.max_value
+            scaled = (channel - lo).astype(np.float32)
+            scaled *= scale
+            np.clip(scaled, 0, self.max_value, out=scaled)
+            scaled += 0.5
+            buffer[c] = scaled
+        return buffer
+
+    def run(self, img):
+        import cv2
+
+        steps = self.steps
+        normalize = bool(steps) and steps[0][0] == "normalize"
+        buffer = self._to_buffer(img, normalize)
+
+        for name, params in steps[1:] if normalize else steps:
+            if name == "clahe":
+                clip_limit, tile_grid_size = params
+                # CLAHE objects keep state, so one per call for thread safety
+                clahe = cv2.createCLAHE(
+                    clipLimit=clip_limit, tileGridSize=tile_grid_size
+                )
+                for channel in buffer:
+                    clahe.apply(channel, dst=channel)
+            elif name == "equalize_hist":
+                for channel in buffer:
+                    cv2.equalizeHist(channel, dst=channel)
+            elif name == "pointwise":
+                tables = self._lookup_tables(params, len(buffer))
+                for channel, table in zip(buffer, tables):
+                    if self.dtype == np.uint8:
+                        cv2.LUT(channel, table, dst=channel)
+                    else:
+                        channel[:] = table[channel]
+
+        return np.ascontiguousarray(buffer.transpose(1, 2, 0))
+
+    def run_batch(self, imgs, max_workers=None):
+        # OpenCV releases the GIL, so frames are processed in parallel threads
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(self.run, imgs))
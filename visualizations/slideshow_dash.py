@@ -1,24 +1,97 @@
-import base64
 import glob
-import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import dash
 import dash_bootstrap_components as dbc
 from dash import Input, Output, State, dcc, html
-from PIL import Image
+from flask import send_from_directory
+from PIL import Image, features
 
+SLICE_DIR = "corrected_punggol_slices"
+# frames are rendered once per slice and width, and re-rendered when a slice changes
+FRAME_DIR = os.path.join(SLICE_DIR, ".frames")
+FRAME_WIDTHS = (480, 960, 1920)
+FRAME_FORMAT = "webp" if features.check("webp") else "png"
+FRAME_URL = "/frames"
+# frames the browser fetches ahead of the one shown
+PREFETCH_FRAMES = 5
+# how often new or changed slices are picked up
+REFRESH_SECONDS = 30
 
-# Function to read and preprocess geotiff files
-def read_img(file_path):
-    return Image.open(file_path)
 
+def slice_date(file_path):
+    return os.path.basename(file_path).split("_")[-1].replace(".tif", "")
+
+
+def render_frames(file_path):
+    """
+    Writes the slice as FRAME_FORMAT images at each of FRAME_WIDTHS narrower than it
+    (and at its own width) and returns {width: url}. Frames newer than the slice
+    are reused. The slice mtime is part of the url, so browsers can cache frames
+    forever and still see a changed slice.
+    """
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    version = int(os.path.getmtime(file_path))
+    urls = {}
+    img = None
+    with Image.open(file_path) as src:
+        widths = [w for w in FRAME_WIDTHS if w < src.width] + [src.width]
+        for width in widths:
+            name = f"{stem}_{width}.{FRAME_FORMAT}"
+            path = os.path.join(FRAME_DIR, name)
+            if not os.path.exists(path) or os.path.getmtime(path) < version:
+                if img is None:
+                    img = src.convert("RGB")
+                height = round(img.height * width / img.width)
+                frame = img.resize((width, height), Image.Resampling.LANCZOS)
+                # written aside and moved in, so a frame is never served half written
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                frame.save(tmp_path, format=FRAME_FORMAT, quality=85, method=4)
+                os.replace(tmp_path, path)
+            # str keys, as they come back from the browser
+            urls[str(width)] = f"{FRAME_URL}/{name}?v={version}"
+    return urls
+
+
+def build_frames():
+    # one entry per slice, in date order: {"date": ..., "urls": {"width": url}}
+    os.makedirs(FRAME_DIR, exist_ok=True)
+    files = sorted(glob.glob(os.path.join(SLICE_DIR, "*.tif")))
+    with ThreadPoolExecutor() as executor:
+        urls = list(executor.map(render_frames, files))
+    return [{"date": slice_date(f), "urls": u} for f, u in zip(files, urls)]
+
+
+_scan_lock = threading.Lock()
+_last_scan = {"time": None, "frames": []}
+
+
+def current_frames():
+    # every viewer polls, but the slices are scanned at most once per
+    # REFRESH_SECONDS; viewers arriving during a scan wait for its result
+    with _scan_lock:
+        now = time.monotonic()
+        if _last_scan["time"] is None or now - _last_scan["time"] >= REFRESH_SECONDS:
+            _last_scan["frames"] = build_frames()
+            _last_scan["time"] = time.monotonic()
+        return _last_scan["frames"]
 
-# Get list of geotiff files
-geotiff_files = sorted(glob.glob("corrected_punggol_slices/*.tif"))
 
 # Initialize the Dash app
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 
+
+@app.server.route(f"{FRAME_URL}/<path:name>")
+def serve_frame(name):
+    # frame urls change with their slice, so they never need revalidating
+    response = send_from_directory(os.path.abspath(FRAME_DIR), name, max_age=31536000)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
 # App layout
 app.layout = dbc.Container(
     [
@@ -84,13 +157,76 @@ app.layout = dbc.Container(
         dcc.Interval(
             id="interval-component", interval=1000, n_intervals=0, disabled=True
         ),
+        dcc.Interval(id="refresh-interval", interval=REFRESH_SECONDS * 1000),
         dcc.Store(id="current-index", data=0),
+        dcc.Store(id="frames", data=current_frames()),
     ]
 )
 
 
-# Callback to update image
+# Callback to pick up new or changed slices
 @app.callback(
+    Output("frames", "data"),
+    Input("refresh-interval", "n_intervals"),
+    State("frames", "data"),
+    prevent_initial_call=True,
+)
+def refresh_frames(n_intervals, frames):
+    new_frames = current_frames()
+    return dash.no_update if new_frames == frames else new_frames
+
+
+# Runs in the browser: every tick only swaps the url of an already fetched frame
+app.clientside_callback(
+    """
+    function(n_intervals, prev_clicks, next_clicks, frames, current_index) {
+        const ctx = window.dash_clientside.callback_context;
+        const trigger = ctx.triggered.length
+            ? ctx.triggered[0].prop_id.split(".")[0]
+            : null;
+        const count = frames.length;
+        if (count === 0) {
+            return ["", "No slices found", 0];
+        }
+
+        let index = Math.min(current_index || 0, count - 1);
+        if (trigger === "prev-button" && index > 0) {
+            index -= 1;
+        } else if (trigger === "next-button" && index < count - 1) {
+            index += 1;
+        } else if (trigger === "interval-component") {
+            index = (index + 1) % count;
+        }
+
+        // smallest rendered width that covers the image on this screen
+        const wanted = window.innerWidth * (window.devicePixelRatio || 1) * 10 / 12;
+        const pick = (frame) => {
+            const widths = Object.keys(frame.urls).map(Number).sort((a, b) => a - b);
+            const width = widths.find((w) => w >= wanted) || widths[widths.length - 1];
+            return frame.urls[width];
+        };
+
+        // fetch the next frames so playback never waits on the network
+        window.slideshowPrefetched = window.slideshowPrefetched || {};
+        for (let k = 1; k <= Math.min(PREFETCH_FRAMES, count - 1); k++) {
+            const url = pick(frames[(index + k) % count]);
+            if (!window.slideshowPrefetched[url]) {
+                const img = new Image();
+                img.src = url;
+                window.slideshowPrefetched[url] = img;
+            }
+        }
+
+        const frame = frames[index];
+        return [
+            pick(frame),
+            `RGB-composite, ${frame.date} (${index + 1}/${count})`,
+            index,
+        ];
+    }
+    """.replace(
+        "PREFETCH_FRAMES", str(PREFETCH_FRAMES)
+    ),
     [
         Output("image-display", "src"),
         Output("image-caption", "children"),
@@ -100,35 +236,10 @@ app.layout = dbc.Container(
         Input("interval-component", "n_intervals"),
         Input("prev-button", "n_clicks"),
         Input("next-button", "n_clicks"),
+        Input("frames", "data"),
     ],
     [State("current-index", "data")],
 )
-def update_image(n_intervals, prev_clicks, next_clicks, current_index):
-    ctx = dash.callback_context
-    if not ctx.triggered:
-        button_id = "No clicks yet"
-    else:
-        button_id = ctx.triggered[0]["prop_id"].split(".")[0]
-
-    if button_id == "prev-button" and current_index > 0:
-        current_index -= 1
-    elif button_id == "next-button" and current_index < len(geotiff_files) - 1:
-        current_index += 1
-    elif button_id == "interval-component":
-        current_index = (current_index + 1) % len(geotiff_files)
-
-    filename = geotiff_files[current_index]
-    date = filename.split("/")[-1].split("_")[-1].replace(".tif", "")
-    img = read_img(filename)
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    img_str = base64.b64encode(buf.getvalue()).decode()
-
-    return (
-        f"data:image/png;base64,{img_str}",
-        f"RGB-composite, {date} ({current_index + 1}/{len(geotiff_files)})",
-        current_index,
-    )
 
 
 # Callback to control playback